@@ -0,0 +1,207 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+import openai
+
+import settings
+from metrics import registry
+
+
+class AdmissionError(Exception):
+    """A request turned away before any work was done; maps to an HTTP error with ``Retry-After``."""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def upstream_limited(error, budgets):
+    """The ``AdmissionError`` to answer with when OpenAI is still rate limiting
+    (429) or timing out (503) after the SDK's retries, or ``None`` for other errors.
+
+    ``Retry-After`` is taken from OpenAI's response when it sent one, and
+    from the time until the OpenAI budget has a token again otherwise.
+    """
+    if isinstance(error, openai.RateLimitError):
+        status_code, detail = 429, "OpenAI rate limit reached, try again shortly"
+    elif isinstance(error, openai.APITimeoutError):
+        status_code, detail = 503, "OpenAI is not responding, try again shortly"
+    else:
+        return None
+    retry_after = budgets.openai.wait_time()
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                retry_after = float(response.headers["retry-after-ms"]) / 1000
+            elif "retry-after" in response.headers:
+                retry_after = float(response.headers["retry-after"])
+        except ValueError:
+            pass  # an HTTP date; keep our own estimate
+    return AdmissionError(status_code, detail, retry_after)
+
+
+class BudgetExhaustedError(Exception):
+    """Raised instead of calling an upstream whose budget has run out."""
+
+
+class TokenBucket:
+    """Refills at ``rate`` tokens per second, holding at most ``capacity``.
+
+    ``charge`` takes tokens after the fact (e.g. the OpenAI tokens a
+    completion actually used) and may leave the bucket in debt; new work
+    waits until it is paid off. A ``rate`` of 0 means no limit.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+    def level(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, amount=1):
+        """Seconds until ``amount`` tokens are available."""
+        if self.unlimited:
+            return 0.0
+        return max(0.0, (amount - self.level()) / self.rate)
+
+    def try_take(self, amount=1):
+        if self.unlimited:
+            return True
+        if self.level() < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def take(self, amount=1, timeout=0.0):
+        """Take ``amount`` tokens, waiting up to ``timeout`` seconds for them."""
+        deadline = time.monotonic() + timeout
+        while not self.try_take(amount):
+            wait = self.wait_time(amount)
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    def charge(self, amount):
+        if not self.unlimited:
+            self.level()
+            self.tokens -= amount
+
+
+class Budgets:
+    """Per-upstream quotas: OpenAI tokens per minute, Google Places and Wikipedia calls per second."""
+
+    def __init__(self, openai_tokens_per_minute=None, places_qps=None, wikipedia_qps=None):
+        openai_tpm = settings.OPENAI_TOKENS_PER_MINUTE if openai_tokens_per_minute is None else openai_tokens_per_minute
+        places_qps = settings.PLACES_QPS if places_qps is None else places_qps
+        wikipedia_qps = settings.WIKIPEDIA_QPS if wikipedia_qps is None else wikipedia_qps
+        self.openai = TokenBucket(openai_tpm / 60, capacity=openai_tpm)
+        self.places = TokenBucket(places_qps)
+        self.wikipedia = TokenBucket(wikipedia_qps)
+
+    def record_usage(self, usage):
+        # ``usage`` from an OpenAI completion; may be missing on errors
+        if usage is not None:
+            self.openai.charge(usage.total_tokens or 0)
+
+    @staticmethod
+    def low(bucket, reserve):
+        """True when less than ``reserve`` (a fraction of its capacity) is left in ``bucket``."""
+        if bucket.unlimited:
+            return False
+        return bucket.level() < bucket.capacity * reserve
+
+    def openai_low(self):
+        """True when the OpenAI budget should be kept for answering visitors."""
+        return self.low(self.openai, settings.OPENAI_BACKGROUND_RESERVE)
+
+
+class Admission:
+    """Caps the requests handled at once; the next ones wait in a bounded queue.
+
+    A request is rejected straight away with 429 while the OpenAI budget is
+    in debt, and with 503 when the queue is full or it has waited
+    ``queue_timeout`` seconds for a slot.
+    """
+
+    def __init__(self, budgets, max_in_flight=None, max_queue=None, queue_timeout=None):
+        self.budgets = budgets
+        self.max_in_flight = max_in_flight or settings.ADMISSION_MAX_IN_FLIGHT
+        self.max_queue = settings.ADMISSION_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout or settings.ADMISSION_QUEUE_TIMEOUT
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+
+    def _reject(self, status_code, reason, detail, retry_after):
+        registry.inc(
+            "citywalk_admission_rejected_total", (("reason", reason),), 1,
+            "Requests turned away by admission control.",
+        )
+        raise AdmissionError(status_code, detail, retry_after)
+
+    async def acquire(self):
+        wait = self.budgets.openai.wait_time()
+        if wait > 0:
+            self._reject(429, "openai_budget", "OpenAI token budget exhausted", wait)
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self._reject(503, "queue_full", "Too many requests, try again shortly", self.queue_timeout)
+
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject(503, "queue_timeout", "Too many requests, try again shortly", self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        registry.observe(
+            "citywalk_admission_wait_seconds", (), time.perf_counter() - start,
+            "Time requests waited in the admission queue.",
+        )
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._slots.release()
+
+    def release_once(self):
+        """A ``release`` for one acquired slot that does nothing after its first call.
+
+        For slots that may be given back from more than one place, e.g. a
+        streamed body and the response that may never start it.
+        """
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.release()
+        return release
+
+    @asynccontextmanager
+    async def admit(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+budgets = Budgets()
@@ -1,9 +1,32 @@
-from openai import OpenAI
+from openai import OpenAIError
+import asyncio
 import json
+import logging
+from jiter import from_json
 import pydantic
-import requests
-import time
 import os
+from typing import Optional
+
+import settings
+from admission import budgets
+from cache import make_cache
+from clients import UpstreamClient, openai_client
+from context import ContextBuilder, prefix_hash
+from gazetteer import Gazetteer
+from geo import geohash_center, geohash_encode
+from memory import summary_messages
+from metrics import registry, span
+from pipeline import Stage, run_stages
+from prefetch import Prefetcher
+from retrieval import RetrievalIndex
+from route import plan_route
+from routing import ModelRouter
+from text import SCRIPT_LANGUAGES, detect_language, detect_script, normalize_text
+
+
+logger = logging.getLogger(__name__)
+
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
 
 
 class Location(pydantic.BaseModel):
@@ -18,13 +41,26 @@ class DisplayNames(pydantic.BaseModel):
     languageCode: str
 
 
+class Route(pydantic.BaseModel):
+    distance_meters: float
+    duration_minutes: float
+
+
 class CityWalkResponse(pydantic.BaseModel):
     locations: list[Location]
     speech: str
+    route: Optional[Route] = None
+
+# what the model returns: location names only, resolved to coordinates afterwards
+class CityWalkDraft(pydantic.BaseModel):
+    locations: list[str]
+    speech: str
+
+# same fields as CityWalkDraft, with the speech first so it can be streamed to TTS
+class CityWalkStreamDraft(pydantic.BaseModel):
+    speech: str
+    locations: list[str]
 
-class InformationSeeking(pydantic.BaseModel):
-    prediction: bool
-    location: str
 
 poi = [
 # 'cultural_landmark *',
@@ -86,154 +122,216 @@ class Preferences(pydantic.BaseModel):
     profession: str
     visited: list[str]
 
-class Language(pydantic.BaseModel):
+class TurnAnalysis(pydantic.BaseModel):
     language: str
+    normalized_query: str
+    prediction: bool
+    location: str
+
+class ConversationSummary(pydantic.BaseModel):
+    summary: str
+
+
+def dialogue_turns(conversation):
+    # strip the context sent along with each user message, keeping only what was said
+    turns = []
+    for message in conversation:
+        content = message['content']
+        if message['role'] == 'user':
+            try:
+                content = json.loads(content)['new_query']
+            except (ValueError, KeyError, TypeError):
+                pass
+        turns.append({"role": message['role'], "content": content})
+    return turns
 
-class Translation(pydantic.BaseModel):
-    translated_text: str
 
 class CityWalkAgent:
-    def __init__(self):
-        self.memory = {}
-        self.language = "English"
-        self.conversation = {}
-        self.client = OpenAI()
+    def __init__(self, client=None, http=None):
+        # both clients can be injected, e.g. with recorded responses for benchmarks
+        self.client = client or openai_client()
+        # one pooled client for Google Places and Wikipedia, with retries and circuit breakers
+        self.http = UpstreamClient.from_settings(http)
+        self.models = ModelRouter.from_settings()
+        self.landmark_cache = make_cache(
+            settings.CACHE_DB_PATH,
+            table="landmarks",
+            maxsize=settings.LANDMARK_CACHE_SIZE,
+            ttl=settings.LANDMARK_CACHE_TTL,
+        )
+        self.context = ContextBuilder()
+        # finished answers to pure information questions, see response_cache_key
+        self.response_cache = make_cache(
+            settings.CACHE_DB_PATH,
+            table="responses",
+            maxsize=settings.RESPONSE_CACHE_SIZE,
+            ttl=settings.RESPONSE_CACHE_TTL,
+        )
+        self.gazetteer = Gazetteer(maxsize=settings.GAZETTEER_SIZE)
+        self.prefetcher = Prefetcher(self)
+        self.retrieval = RetrievalIndex(
+            settings.RETRIEVAL_CORPUS_DIR,
+            embedding_model=settings.RETRIEVAL_EMBEDDING_MODEL,
+            index_dir=settings.RETRIEVAL_INDEX_DIR,
+        )
+        self.place_cache = make_cache(
+            settings.CACHE_DB_PATH,
+            table="places",
+            maxsize=settings.PLACE_CACHE_SIZE,
+            ttl=settings.PLACE_CACHE_TTL,
+        )
+        # normalized search term -> pageid (0 when nothing was found)
+        self.wikipedia_search_cache = make_cache(
+            settings.CACHE_DB_PATH,
+            table="wikipedia_search",
+            maxsize=settings.WIKIPEDIA_CACHE_SIZE,
+            ttl=settings.WIKIPEDIA_CACHE_TTL,
+        )
+        # "full:<pageid>" -> plain text extract
+        self.wikipedia_article_cache = make_cache(
+            settings.CACHE_DB_PATH,
+            table="wikipedia_articles",
+            maxsize=settings.WIKIPEDIA_CACHE_SIZE,
+            ttl=settings.WIKIPEDIA_CACHE_TTL,
+        )
+        # never formatted: the same bytes open every prompt so the provider can cache them
         self.system_prompt =  {
             "role": "system",
             "content": """
             You are Hugo, a multilingual professional Personal Tour Guide. 
             You are taking a visitor on a city walk.
-            Your speech response should ALWAYS be in the language of {language}. 
+            Your speech response should ALWAYS be in the language given as "language" in the TURN CONTEXT. 
             You will be provided with a list of information about the city and the visitor's interests.
+            Before each visitor message you get a TURN CONTEXT with the current city, nearby landmarks and additional information for that message; only the latest one is up to date.
             You will need to use this information to answer the visitor's questions and provide them with a memorable experience.
             You should always ask some clarifying questions to understand the visitor's interests and preferences.
             Whenever you provide a recommendation, you must provide a list of locations and a speech response, locations shouldn't be too far from the starting point.
-            Try your best to provide the list of locations that provide the best route for the visitor to take, so they don't have to backtrack.
             Since the visitor will be able to visualize on locations you are recommending, keep the your speech short, informative, and engaging; but the locations should be detailed and accurate. 
             Here are some examples of the types of responses you might provide:
             Make sure the tone is relaxed and friendly, some jokes or light-hearted comments are always welcome.
             
             for information seeking queries, you should provide about 5 sentences of information about the location, guide the visitor to ask more questions if they want to know more.
 
-            ADDITIONAL INFORMATION:
-            {additional_info}
-
             JSON example 1: location recommnedations:
-            {{
+            {
                 "locations": ['location 1', 'location 2', 'location 3', ..., 'location N'],
                 "speech": "Based on your preferences, what about try talking a walk from location 1 to location N? it should take you about 2 hours and you will see some interesting places on the way."
-            }}
+            }
 
             JSON example 2: clarifying questions: the goal is to get more information from the visitor to refine the recommendations
-            {{
+            {
                 "locations": [],
                 "speech": "to get started, could you tell me a bit more about what you are interested in seeing? or how much time you would like to spent?"
-            }}
+            }
             
             JSON examples 3: general information: providing information about the point of interest
-            {{
+            {
                 "locations": [],
                 "speech": "Great Mall is built in 1992 and is the largest shopping mall in the city. It has over 200 stores and a food court with a variety of options."
-            }}
+            }
 
             JSON examples 4: greeting: greeting the visitor
-            {{
+            {
                 "locations": [],
                 "speech": "Hello! I will help you explore the city and find the best places to visit. What would you like to see today?"
-            }}
+            }
 
             JSON examples 5: revised recommendations: providing revised recommendations based on the visitor's feedback
             !important: make sure the revised recommendations are similar to the original recommendations, but with some changes based on the visitor's feedback
             !important: avoid making drastic changes to the recommendations
-            {{
-                "locations": ['location 1', 'location 2', 'location 3', ..., 'location N'], # it's important to keep the order of the locations similar to the original recommendations
+            {
+                "locations": ['location 1', 'location 2', 'location 3', ..., 'location N'],
                 "speech": "Based on what your preferences, I think you would enjoy visiting location 1, location 2, and location N. Would you like to know more about these places?"
-            }}
+            }
 
             JSON examples 6: reset conversation: reset the conversation to the beginning, for example, if the visitor's says something like let's restart, start over, etc.
-            {{
+            {
                 "locations": [],
                 "speech": "Sure! Let's start over. What would you like to see today?"
-            }}
+            }
 
             """
         }
-        self.conversation = []
 
-    def conversation_reset(self):
-        self.conversation = []
-
-        
-    def get_wikipedia_article(self, query):
-
-        # Step 1: Perform the search to get article snippets
-        search_url = "https://en.wikipedia.org/w/api.php"
-        search_params = {
+    def record_usage(self, stage, usage):
+        # OpenAI tokens count against the per-minute budget after the fact
+        stage.record_usage(usage)
+        budgets.record_usage(usage)
+
+    async def aclose(self):
+        await self.http.aclose()
+        await self.client.close()
+
+    async def get_wikipedia_article(self, query):
+        term = normalize_text(query)
+        pageid = self.wikipedia_search_cache.get(term)
+        if pageid is not None:
+            if not pageid:
+                return ""
+            return await self.get_wikipedia_extract(pageid)
+
+        # search and fetch the top result's extract in a single round trip
+        params = {
             'action': 'query',
-            'list': 'search',
-            'srsearch': query,  # Replace with your search term
+            'generator': 'search',
+            'gsrsearch': query,
+            'gsrlimit': 1,
+            'prop': 'extracts',
+            'explaintext': 1,  # Returns plain text; remove for HTML content
             'format': 'json'
         }
-
-        search_response = requests.get(search_url, params=search_params)
-        search_data = search_response.json()
-
-        # Check if search results are available
-        if search_data.get('query') and search_data['query'].get('search'):
-            first_result = search_data['query']['search'][0]
-            pageid = first_result['pageid']
-            
-            # Step 2: Retrieve the full article content using the pageid
-            article_url = "https://en.wikipedia.org/w/api.php"
-            article_params = {
-                'action': 'query',
-                'prop': 'extracts',
-                'pageids': pageid,
-                'explaintext': True,  # Returns plain text; remove for HTML content
-                'format': 'json'
-            }
-            
-            article_response = requests.get(article_url, params=article_params)
-            article_data = article_response.json()
-            
-            # The extract is contained in the pages object, with the key as the pageid
-            full_article = article_data['query']['pages'][str(pageid)]['extract']
-            return full_article
-        else:
+        with span("wikipedia") as stage:
+            response = await self.http.get("wikipedia", WIKIPEDIA_API_URL, params=params)
+            stage.record_response(response)
+        if not response.is_success:
+            return ""
+        pages = response.json().get('query', {}).get('pages', {})
+        if not pages:
+            self.wikipedia_search_cache.set(term, 0)
             return ""
 
+        page = next(iter(pages.values()))
+        article = page.get('extract', "")
+        self.wikipedia_search_cache.set(term, page['pageid'])
+        self.wikipedia_article_cache.set(f"full:{page['pageid']}", article)
+        return article
 
+    async def get_wikipedia_extract(self, pageid):
+        """Plain text of the whole article ``pageid``, or ``""``."""
+        cache_key = f"full:{pageid}"
+        cached = self.wikipedia_article_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    def language_detection(self, query):
-        # use the query to determine the language
-        system_prompt = """
-            You will be provided with the user query.
-            based on the user query. Classify the language of the user query.
-
-            return the language type in the following json format:
-            {{
-                "language": "language"
-            }}
-
-            USER QUERY:
-            {query}
-        """
+        params = {
+            'action': 'query',
+            'prop': 'extracts',
+            'pageids': pageid,
+            'explaintext': 1,
+            'format': 'json'
+        }
+        with span("wikipedia") as stage:
+            response = await self.http.get("wikipedia", WIKIPEDIA_API_URL, params=params)
+            stage.record_response(response)
+        if not response.is_success:
+            return ""
+        page = response.json().get('query', {}).get('pages', {}).get(str(pageid), {})
+        if 'extract' not in page:
+            return ""
+        self.wikipedia_article_cache.set(cache_key, page['extract'])
+        return page['extract']
 
-        completion = self.client.beta.chat.completions.parse(
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=100,
-            top_p=1,
-            messages=[{
-                "role": "system",
-                "content": system_prompt.format(query=query)
-            }],
-            response_format=Language
-        )
 
-        return completion.choices[0].message.dict()['parsed']['language']
 
-    def get_nearby_landmarks(self, city):
+    async def get_nearby_landmarks(self, city):
+        # landmarks are cached per geohash tile; searching from the tile centre
+        # gives every city centre inside the tile the same cacheable answer
+        tile = geohash_encode(city['latitude'], city['longitude'], settings.LANDMARK_CACHE_PRECISION)
+        cache_key = f"{tile}:{','.join(poi)}"
+        places = self.landmark_cache.get(cache_key)
+        if places is not None:
+            return places
+        latitude, longitude = geohash_center(tile)
 
         headers = {
             'Content-Type': 'application/json',
@@ -249,18 +347,20 @@ class CityWalkAgent:
             'locationRestriction': {
                 'circle': {
                     'center': {
-                        'latitude': city['latitude'],
-                        'longitude': city['longitude'],
+                        'latitude': latitude,
+                        'longitude': longitude,
                     },
                     'radius': 5000.0,
                 },
             },
         }
 
-        response = requests.post('https://places.googleapis.com/v1/places:searchNearby', headers=headers, json=json_data)
-        if 'places' not in response.json():
+        with span("places_nearby") as stage:
+            response = await self.http.post("places", 'https://places.googleapis.com/v1/places:searchNearby', headers=headers, json=json_data)
+            stage.record_response(response)
+        if not response.is_success:
             return []
-        places = response.json()['places']
+        places = response.json().get('places', [])
         # pop location and repopulate with values
         for place in places:
             location = place.pop('location')
@@ -269,15 +369,17 @@ class CityWalkAgent:
             place['location'] = location
             place['location']['displayName'] = displayName
             place['location']['rating'] = rating
+        self.landmark_cache.set(cache_key, places)
         return places
     
-    def infer_user_preferences(self):
-        # use the conversation to infer the user preferences
+    async def infer_user_preferences(self, conversation, previous=None):
+        # use the newest conversation turns to update the previously inferred preferences
         system_prompt = """
             You are a professional Personal Tour Guide. You are taking a visitor on a city walk.
-            You will be provided the entire conversation history between the visitor and the assistant.
+            You will be provided the visitor's previously inferred preferences and the newest turns of the conversation between the visitor and the assistant.
             You will need to use this information to infer the visitor's interests and preferences.
-            collect the information from the conversation history and provide a list of preferences.
+            collect the information from the new conversation turns and provide the updated list of preferences.
+            Keep the previous preferences unless the visitor explicitly contradicts them in the new turns.
             The preferences should be a list of strings that represent the visitor's interests.
             For example, if the visitor mentioned that they like museums, you should include "museum" in the list of preferences.
             If the visitor mentioned that they like to walk, you should include "walking" in the list of preferences.
@@ -299,63 +401,168 @@ class CityWalkAgent:
                 "visited": ["museum", "park", "restaurant"]
             }}
 
-            CONVERSATION HISTORY:
+            PREVIOUS PREFERENCES:
+            {previous}
+
+            NEW CONVERSATION TURNS:
             {conversations}
 
         """
-    
+
+        # only what the visitor said matters here, not the landmark data sent along with it
         system_turn = [{
             "role": "system",
-            "content": system_prompt.format(conversations=json.dumps(self.conversation))
+            "content": system_prompt.format(previous=json.dumps(previous or {}), conversations=json.dumps(dialogue_turns(conversation)))
         }]
 
-        completion = self.client.beta.chat.completions.parse(
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=4000,
-            top_p=1,
-            messages=system_turn,
-            response_format=Preferences
-        )
+        with span("preference_inference") as stage:
+            completion = await self.client.beta.chat.completions.parse(
+                **self.models.params("preference_inference"),
+                messages=system_turn,
+                response_format=Preferences
+            )
+            self.record_usage(stage, completion.usage)
         return completion.choices[0].message.dict()['parsed']
 
-    def search_location(self, location_name):
+    async def summarize_conversation(self, summary, conversation):
+        # fold the given turns into the running summary of the conversation
+        system_prompt = """
+            You are a professional Personal Tour Guide. You are taking a visitor on a city walk.
+            You will be provided the running summary of the conversation so far and some older turns of the conversation that are about to be dropped.
+            Update the summary so it also covers the new turns. Keep everything that matters for the rest of the walk:
+            places that were recommended or visited, questions the visitor asked, what they liked or disliked, and any plans you agreed on.
+            Keep the summary short, at most 10 sentences, and written in English.
+
+            return the summary in the following json format:
+            {{
+                "summary": "summary"
+            }}
+
+            CURRENT SUMMARY:
+            {summary}
+
+            TURNS TO ADD:
+            {conversations}
+        """
+
+        with span("conversation_summary") as stage:
+            completion = await self.client.beta.chat.completions.parse(
+                **self.models.params("conversation_summary"),
+                messages=[{
+                    "role": "system",
+                    "content": system_prompt.format(summary=summary or "(empty)", conversations=json.dumps(dialogue_turns(conversation)))
+                }],
+                response_format=ConversationSummary
+            )
+            self.record_usage(stage, completion.usage)
+        return completion.choices[0].message.dict()['parsed']['summary']
+
+    async def search_location(self, location_name, city=None):
+        # cached per name and, when the city is known, per ~20 km geohash cell around it
+        area = geohash_encode(city['latitude'], city['longitude'], 4) if city else "any"
+        cache_key = f"{area}:{normalize_text(location_name)}"
+        place = self.place_cache.get(cache_key)
+        if place is not None:
+            return place
 
         headers = {
             'Content-Type': 'application/json',
             'X-Goog-Api-Key': os.getenv('GOOGLE_API_KEY'),
-            'X-Goog-FieldMask': 'places.displayName,places.formattedAddress,places.priceLevel,places.id,places.reviews,places.generativeSummary',
+            'X-Goog-FieldMask': 'places.displayName,places.formattedAddress,places.priceLevel,places.id,places.reviews,places.generativeSummary,places.location,places.rating',
         }
 
         json_data = {
             'textQuery': location_name,
         }
+        if city:
+            json_data['locationBias'] = {
+                'circle': {
+                    'center': {
+                        'latitude': city['latitude'],
+                        'longitude': city['longitude'],
+                    },
+                    'radius': 20000.0,
+                },
+            }
 
-        response = requests.post('https://places.googleapis.com/v1/places:searchText', headers=headers, json=json_data)
-
-        return response.json()['places'][0]
+        with span("places_text_search") as stage:
+            response = await self.http.post("places", 'https://places.googleapis.com/v1/places:searchText', headers=headers, json=json_data)
+            stage.record_response(response)
+        if not response.is_success or not response.json().get('places'):
+            return None
+        place = response.json()['places'][0]
+        self.place_cache.set(cache_key, place)
+        if 'location' in place:
+            self.gazetteer.add(
+                place['displayName']['text'], place['location']['latitude'], place['location']['longitude'], place.get('rating', 0)
+            )
+        return place
+
+    async def resolve_locations(self, names, city):
+        """Turn the location names chosen by the model into ``Location`` dicts.
+
+        Names are matched against the gazetteer of landmarks already fetched;
+        only the misses go to the (cached) Places text search, all at once.
+        Names that can't be resolved are dropped rather than given made-up
+        coordinates.
+        """
+        resolved = {}
+        misses = []
+        for name in names:
+            place = self.gazetteer.lookup(name, city['latitude'], city['longitude'], settings.GAZETTEER_RADIUS_M)
+            if place is None:
+                misses.append(name)
+            else:
+                resolved[name] = place
+
+        places = await asyncio.gather(*[self.search_location(name, city) for name in misses], return_exceptions=True)
+        for name, place in zip(misses, places):
+            if isinstance(place, Exception) or not place or 'location' not in place:
+                continue
+            resolved[name] = {
+                "displayName": place['displayName']['text'],
+                "latitude": place['location']['latitude'],
+                "longitude": place['location']['longitude'],
+                "rating": place.get('rating', 0.0),
+            }
+        return [resolved[name] for name in names if name in resolved]
 
 
 
-    def is_location_information_seeking(self, query):
-        # use the query to determine if the user is seeking information
+    async def analyze_turn(self, query, session):
+        # one call for the language, the normalized query and the intent of the
+        # turn; the language is only fixed up front when the query itself
+        # settles it, so that a visitor switching language is always noticed
+        if settings.LOCAL_LANGUAGE_DETECTION:
+            known_language = detect_language(query) or None
+        else:
+            known_language = SCRIPT_LANGUAGES.get(detect_script(query)) or None
 
         system_prompt = """
             You will be provided with the user query and the conversation history between the visitor and the assistant.
-            based on the last user query and the conversation history, you need to determine if the user is seeking information.
-            if the user is seeking information about a specific location, you should return True, otherwise, return False.
-            when true, you should also return the location name that the user is seeking information about if multiple locations are mentioned in the query, return the most specific location.
-            Positive examples of the types of queries that the user might ask:
+            Analyze the last user query and return:
+            - language: the language the user query is written in, e.g. "English", "Chinese". If KNOWN LANGUAGE is given, return it unchanged.
+            - normalized_query: the user query rewritten as a short, self-contained request in the same language, resolving references to earlier turns (e.g. "the second one" -> the name of that place).
+            - prediction: based on the last user query and the conversation history, true if the user is seeking information about a specific location, otherwise false.
+            - location: when prediction is true, the location name that the user is seeking information about; if multiple locations are mentioned in the query, return the most specific location. Otherwise an empty string.
+
+            Positive examples of information seeking queries:
             - Tell me about the history of the city.
             - Introduction to the city.
             - Who lives in this place?
             - Tell me about place X in location Y.  #! important location X is the most specific location in the city so return location X
 
-            Negative examples of the types of queries that the user might ask:
+            Negative examples of information seeking queries:
             - What are some interesting places to visit in the city?
             - Can you recommend some good restaurants in the city?
             - What are the best places to visit in the city?
-        
+
+            KNOWN LANGUAGE:
+            {known_language}
+
+            SUMMARY OF THE EARLIER CONVERSATION:
+            {summary}
+
             CONVERSATION HISTORY:
             {conversations}
 
@@ -364,126 +571,266 @@ class CityWalkAgent:
 
             response in the following JSON format:
             {{
-                "prediction": true | false
-                "location": "location name" | null
+                "language": "language",
+                "normalized_query": "normalized query",
+                "prediction": true | false,
+                "location": "location name" | ""
             }}
         """
-        completion = self.client.beta.chat.completions.parse(
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=4000,
-            top_p=1,
-            messages=[{
-                "role": "system",
-                "content": system_prompt.format(conversations=json.dumps(self.conversation), query=query)
-            }],
-            response_format=InformationSeeking
-        )
-        
-        return completion.choices[0].message.dict()['parsed']
-
-    def translate(self, text):
-        # translate the text to the user language
-        system_prompt = """
-            You will be provided with the text that needs to be translated to the target language.
-            Translate the text to the language of the user query.
-
-            return the translated text in the following json format:
-            {{
-                "translated_text": "translated text"
-            }}
-
-            TARGET LANGUAGE:
-            {target_language}
-
-            TEXT TO TRANSLATE:
-            {text}
+        with span("analysis") as stage:
+            try:
+                completion = await self.client.beta.chat.completions.parse(
+                    **self.models.params("analysis"),
+                    messages=[{
+                        "role": "system",
+                        "content": system_prompt.format(
+                            known_language=known_language or "unknown",
+                            summary=session.summary,
+                            conversations=json.dumps(dialogue_turns(session.conversation)),
+                            query=query
+                        )
+                    }],
+                    response_format=TurnAnalysis
+                )
+                self.record_usage(stage, completion.usage)
+                analysis = completion.choices[0].message.dict()['parsed']
+                if analysis is None:
+                    logger.warning("Turn analysis was refused, continuing without it: %s", completion.choices[0].message.refusal)
+            except OpenAIError as e:
+                # answer without the analysis rather than failing the turn; this
+                # includes a completion cut off at max_tokens before the JSON ended
+                logger.warning("Turn analysis failed, continuing without it: %r", e)
+                if getattr(e, "completion", None) is not None:
+                    self.record_usage(stage, e.completion.usage)
+                analysis = None
+
+        if analysis is None:
+            analysis = {"language": session.language, "normalized_query": query, "prediction": False, "location": ""}
+        if known_language:
+            analysis['language'] = known_language
+        return analysis
+
+    def response_cache_key(self, analysis, city):
+        # pure information answers only depend on the place, what is asked about
+        # it, the area and the language
+        if not analysis['prediction'] or not analysis['location']:
+            return None
+        cell = geohash_encode(city['latitude'], city['longitude'], settings.RESPONSE_CACHE_PRECISION)
+        return ":".join([
+            cell,
+            normalize_text(analysis['language']),
+            normalize_text(analysis['location']),
+            normalize_text(analysis['normalized_query']),
+        ])
+
+    async def prepare_turn(self, query, metadata, first_request, session):
+        """Gather the context for the turn.
+
+        Returns a dict with the ``messages`` for the main completion, the
+        ``new_message`` to add to the history, and the response ``cache_key``.
+        When an earlier answer to the same information question is cached it
+        is returned as ``cached`` and the Places and Wikipedia lookups are
+        skipped. The ``cache_key`` is ``None`` when the answer must not be
+        cached, e.g. because one of those lookups failed.
+        Questions about a location from the last recommendation use the details
+        prefetched for it (see ``Prefetcher``).
         """
-
-        completion = self.client.beta.chat.completions.parse(
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=500,
-            top_p=1,
-            messages=[{
-                "role": "system",
-                "content": system_prompt.format(text=text, target_language=self.language)
-            }],
-            response_format=Translation
-        )
-
-        return completion.choices[0].message.dict()['parsed']['translated_text']
-
-
-    def answer(self, query, metadata, first_request):
-        if first_request:
-            self.language = self.language_detection(query)
-        else:
-            query = self.translate(query)
         city = metadata.city.dict()
-        # time to get the landmarks
-        start = time.time()
-        landmarks = self.get_nearby_landmarks(city)
-        end = time.time()
-        # time to get the response
-        start = time.time()
-        new_message = {
-                "role": "user",
-                "content": json.dumps({
-                    "current_city": city,
-                    "near_by_landmarks": landmarks,
-                    "new_query": query
-                })
-            }
-        
-        loc_info = self.is_location_information_seeking(query)
-
-        additional_info = {}
-
-        if loc_info['prediction']:
-            location = loc_info['location']
-            location_info = self.search_location(location)
-            additional_info['location_info'] = {location: location_info}
-            additional_info['location_info']['wikipedia'] = self.get_wikipedia_article(location)
-        else:
-            additional_info['general_info'] = {'wikipedia': self.get_wikipedia_article(query)}
-        new_system_prompt = {
-            "role": "system",
-            "content": self.system_prompt['content']
+        if first_request:
+            self.prefetcher.cancel(session.session_id)
+
+        async def lookup_cached(analysis):
+            key = self.response_cache_key(analysis, city)
+            return self.response_cache.get(key) if key else None
+
+        async def lookup_prefetched(analysis, cached):
+            if cached or not analysis['prediction']:
+                return None
+            return await self.prefetcher.result(session, analysis['location'])
+
+        async def lookup_location(analysis, cached, prefetched):
+            if cached or not analysis['prediction']:
+                return None
+            if prefetched and prefetched['place']:
+                return prefetched['place']
+            return await self.search_location(analysis['location'], city)
+
+        async def lookup_wikipedia(analysis, cached, prefetched):
+            if cached:
+                return ""
+            if prefetched and prefetched['article'] is not None:
+                return prefetched['article']
+            term = analysis['location'] if analysis['prediction'] else analysis['normalized_query']
+            article = await self.get_wikipedia_article(term)
+            # keep it around for local retrieval in later turns; chunking and
+            # tokenizing a long article is CPU work that would stall the event loop
+            await asyncio.to_thread(self.retrieval.add_article, term, article, city.get('name', ''))
+            return article
+
+        async def search_passages():
+            with span("retrieval"):
+                # BM25 scoring and the embedding model run in a worker thread
+                return await asyncio.to_thread(self.retrieval.search, query, city.get('name', ''), settings.RETRIEVAL_TOP_K)
+
+        # the turn analysis and nearby landmarks don't depend on each other;
+        # the Places and Wikipedia lookups only need the analysis
+        fallbacks = set()
+        results = await run_stages([
+            Stage("analysis", lambda: self.analyze_turn(query, session)),
+            Stage("landmarks", lambda: self.get_nearby_landmarks(city), timeout=settings.STAGE_TIMEOUT, default=[]),
+            Stage("cached", lookup_cached, deps=["analysis"], default=None),
+            Stage("prefetched", lookup_prefetched, deps=["analysis", "cached"], timeout=settings.STAGE_TIMEOUT, default=None),
+            Stage("location_info", lookup_location, deps=["analysis", "cached", "prefetched"], timeout=settings.STAGE_TIMEOUT, default=None),
+            Stage("wikipedia", lookup_wikipedia, deps=["analysis", "cached", "prefetched"], timeout=settings.STAGE_TIMEOUT, default=""),
+            Stage("passages", search_passages, default=[]),
+        ], fallbacks)
+        analysis = results["analysis"]
+        self.gazetteer.add_landmarks(results["landmarks"])
+        if analysis['prediction'] and not self.prefetcher.covers(session, analysis['location']):
+            # asking about a place that wasn't recommended: the visitor has moved on
+            self.prefetcher.cancel(session.session_id)
+        session.language = analysis['language']
+
+        # the history only keeps what was said, so earlier turns never change
+        new_message = {"role": "user", "content": query}
+        turn = {
+            "city": city,
+            "new_message": new_message,
+            # an answer written without the place's details must not be served to others
+            "cache_key": None if fallbacks & {"location_info", "wikipedia"} else self.response_cache_key(analysis, city),
+            "cached": results["cached"],
+            "about_location": analysis['prediction'],
+            "messages": None,
         }
-        new_system_prompt['content'] = new_system_prompt['content'].format(additional_info=json.dumps(additional_info), language=self.language)
-
-            
+        if turn["cached"]:
+            return turn
+
+        # everything that changes per turn goes after the history, right before the query
+        turn_context = {
+            "language": session.language,
+            "current_city": city,
+            "near_by_landmarks": self.context.landmarks(results["landmarks"]),
+            "additional_info": self.context.additional_info(
+                analysis['normalized_query'], analysis, results["location_info"], results["wikipedia"], results["passages"]
+            ),
+        }
+        prefix = [self.system_prompt] + summary_messages(session) + session.conversation
+        self.check_prefix(session, prefix)
+        turn["messages"] = prefix + [
+            {"role": "system", "content": f"TURN CONTEXT:\n{json.dumps(turn_context, ensure_ascii=False)}"},
+            new_message,
+        ]
+        return turn
+
+    def check_prefix(self, session, prefix):
+        # the prompt of the previous turn must still open this one, or the
+        # provider's prompt cache misses; expected only after a summary fold
+        if session.prefix_messages and (
+            len(prefix) < session.prefix_messages
+            or prefix_hash(prefix[:session.prefix_messages]) != session.prefix_hash
+        ):
+            logger.info("Prompt prefix of session %s changed since the last turn", session.session_id)
+            registry.inc(
+                "citywalk_prompt_prefix_changes_total", (), 1,
+                "Turns whose prompt no longer starts with the previous turn's prompt prefix.",
+            )
+        session.prefix_messages = len(prefix)
+        session.prefix_hash = prefix_hash(prefix)
+
+    async def build_response(self, draft, city):
+        # pin the recommended locations and order them into a walk from the city centre
+        locations = await self.resolve_locations(draft['locations'], city)
+        response = {"locations": locations, "speech": draft['speech'], "route": None}
+        if locations:
+            locations, distance, minutes = plan_route(city, locations, settings.WALKING_SPEED_KMH)
+            response['locations'] = locations
+            response['route'] = {"distance_meters": distance, "duration_minutes": minutes}
+        return response
 
-        completion = self.client.beta.chat.completions.parse(
-            model="gpt-4o",
-            temperature=1,
-            max_tokens=4000,
-            top_p=1,
-            messages=[new_system_prompt] + self.conversation + [new_message],
-            response_format=CityWalkResponse
-        )
-        end = time.time()
-        
-        response = completion.choices[0].message.dict()['parsed']
+    def finish_turn(self, session, turn, response):
+        if turn["cache_key"] and not turn["cached"]:
+            self.response_cache.set(turn["cache_key"], response)
         new_response = {
             "role": "assistant",
             "content": response['speech']
         }
-        self.conversation.append(new_message)
-        self.conversation.append(new_response)
-
-        self.preferences = self.infer_user_preferences()
+        session.conversation.append(turn["new_message"])
+        session.conversation.append(new_response)
+        session.turns += 1
+        # a new recommendation replaces whatever was prefetched for the last one,
+        # and a turn about neither places nor a recommendation drops it
+        if settings.PREFETCH_ENABLED and response['locations'] and not turn["cached"]:
+            self.prefetcher.start(session, [location['displayName'] for location in response['locations']], turn["city"])
+        elif not response['locations'] and not turn["about_location"]:
+            self.prefetcher.cancel(session.session_id)
+
+    async def answer(self, query, metadata, first_request, session):
+        turn = await self.prepare_turn(query, metadata, first_request, session)
+        if turn["cached"]:
+            self.finish_turn(session, turn, turn["cached"])
+            return turn["cached"]
+
+        with span("main_completion") as stage:
+            completion = await self.client.beta.chat.completions.parse(
+                **self.models.params("main_completion"),
+                messages=turn["messages"],
+                response_format=CityWalkDraft
+            )
+            self.record_usage(stage, completion.usage)
+
+        draft = completion.choices[0].message.dict()['parsed']
+        response = await self.build_response(draft, metadata.city.dict())
+        self.finish_turn(session, turn, response)
         return response
-    
+
+    async def answer_stream(self, query, metadata, first_request, session):
+        """Like ``answer``, but yields ``(event, data)`` pairs while the completion streams.
+
+        ``speech`` events carry new pieces of the speech text as soon as the
+        model produces them, followed by one ``locations`` event and a final
+        ``done`` event with the whole response.
+        """
+        turn = await self.prepare_turn(query, metadata, first_request, session)
+        if turn["cached"]:
+            response = turn["cached"]
+            yield "speech", response['speech']
+            yield "locations", response['locations']
+            self.finish_turn(session, turn, response)
+            yield "done", response
+            return
+
+        speech = ""
+        draft = None
+        with span("main_completion") as stage:
+            async with self.client.beta.chat.completions.stream(
+                **self.models.params("main_completion"),
+                messages=turn["messages"],
+                response_format=CityWalkStreamDraft,
+                stream_options={"include_usage": True}
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content.delta":
+                        # the SDK's partial parse drops unfinished strings, so parse the snapshot ourselves
+                        partial = from_json(event.snapshot.encode(), partial_mode="trailing-strings")
+                        text = partial.get("speech", "") if isinstance(partial, dict) else ""
+                        if len(text) > len(speech):
+                            yield "speech", text[len(speech):]
+                            speech = text
+                    elif event.type == "content.done":
+                        draft = event.parsed.dict()
+                self.record_usage(stage, (await stream.get_final_completion()).usage)
+
+        response = await self.build_response(draft, metadata.city.dict())
+        yield "locations", response['locations']
+        self.finish_turn(session, turn, response)
+        yield "done", response
+
 
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
-    agent = CityWalkAgent()
-    landmarks = agent.get_nearby_landmarks(city={"latitude": 40.7128, "longitude": -74.0060})
-    print(landmarks)
+    from sessions import Session
     from pydantic import BaseModel
     class City(BaseModel):
         latitude: float
@@ -492,9 +839,16 @@ if __name__ == "__main__":
         city: City
         is_first_request: bool
 
-    city = City(latitude=40.7128, longitude=-74.0060)
-    metadata = MetaData(city=city, is_first_request=True)
+    async def main():
+        agent = CityWalkAgent()
+        landmarks = await agent.get_nearby_landmarks(city={"latitude": 40.7128, "longitude": -74.0060})
+        print(landmarks)
+
+        city = City(latitude=40.7128, longitude=-74.0060)
+        metadata = MetaData(city=city, is_first_request=True)
+
+        response = await agent.answer("What are some interesting places to visit in New York?", metadata, True, Session(session_id="cli"))
+        print(response)
+        await agent.aclose()
 
-    response = agent.answer("What are some interesting places to visit in New York?", metadata=metadata)
-    print(response)
-    
\ No newline at end of file
+    asyncio.run(main())
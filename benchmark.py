@@ -0,0 +1,271 @@
+"""Offline load test for the /answer endpoints.
+
+Replays the recorded responses in benchmark_fixtures/ through injected
+OpenAI, Google Places and Wikipedia clients with configurable latency,
+drives the app with N concurrent simulated sessions and reports
+throughput, latency percentiles and a per-stage breakdown. Needs no
+network access and no API keys.
+
+    python benchmark.py --sessions 20 --turns 6 --openai-latency 800
+    python benchmark.py --stream --cold
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict
+
+import httpx
+import uvicorn
+from openai import AsyncOpenAI
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_fixtures", "new_york.json")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Upstreams:
+    """Stand-ins for OpenAI, Google Places and Wikipedia that answer from fixtures."""
+
+    def __init__(self, fixtures, openai_latency, places_latency, wikipedia_latency, jitter):
+        self.fixtures = fixtures
+        self.openai_latency = openai_latency
+        self.places_latency = places_latency
+        self.wikipedia_latency = wikipedia_latency
+        self.jitter = jitter
+        self.calls = defaultdict(int)
+
+    async def delay(self, ms):
+        if ms > 0:
+            await asyncio.sleep(ms * random.uniform(1 - self.jitter, 1 + self.jitter) / 1000)
+
+    def completion_content(self, name, prompt):
+        openai = self.fixtures["openai"]
+        if name == "TurnAnalysis":
+            query = prompt.split("USER QUERY:")[-1]
+            for item in self.fixtures["queries"]:
+                if item["query"] in query:
+                    return item["analysis"]
+            return self.fixtures["queries"][0]["analysis"]
+        if name in ("CityWalkDraft", "CityWalkStreamDraft"):
+            content = openai["information"] if "location_info" in prompt else openai["recommendation"]
+            if name == "CityWalkStreamDraft":
+                return {"speech": content["speech"], "locations": content["locations"]}
+            return {"locations": content["locations"], "speech": content["speech"]}
+        return openai[name]
+
+    async def openai(self, request):
+        body = json.loads(request.content)
+        name = body["response_format"]["json_schema"]["name"]
+        self.calls[f"openai:{name}"] += 1
+        await self.delay(self.openai_latency)
+
+        prompt = json.dumps(body["messages"])
+        content = json.dumps(self.completion_content(name, prompt))
+        usage = {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": (len(prompt) + len(content)) // 4,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        base = {"id": "benchmark", "created": 0, "model": body["model"]}
+        if not body.get("stream"):
+            return httpx.Response(200, json={
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                "usage": usage,
+            })
+
+        async def chunks():
+            for i in range(0, len(content), 16):
+                delta = {"content": content[i:i + 16]}
+                if i == 0:
+                    delta["role"] = "assistant"
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+                await asyncio.sleep(0.002)
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+            if body.get("stream_options", {}).get("include_usage"):
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=chunks())
+
+    async def http(self, request):
+        url = request.url
+        if url.host == "places.googleapis.com":
+            await self.delay(self.places_latency)
+            if url.path.endswith("searchNearby"):
+                self.calls["places:searchNearby"] += 1
+                return httpx.Response(200, json=self.fixtures["places_nearby"])
+            self.calls["places:searchText"] += 1
+            query = json.loads(request.content)["textQuery"].lower()
+            results = self.fixtures["places_text_search"]
+            for name, result in results.items():
+                if name.lower() in query or query in name.lower():
+                    return httpx.Response(200, json=result)
+            return httpx.Response(200, json=next(iter(results.values())))
+
+        if url.host.endswith("wikipedia.org"):
+            await self.delay(self.wikipedia_latency)
+            self.calls["wikipedia"] += 1
+            params = dict(url.params)
+            pages = self.fixtures["wikipedia"]
+            if "gsrsearch" in params:
+                term = params["gsrsearch"].lower()
+                page = next((page for name, page in pages.items() if name.lower() in term), next(iter(pages.values())))
+                return httpx.Response(200, json={"query": {"pages": {str(page["pageid"]): page}}})
+            by_id = {str(page["pageid"]): page for page in pages.values()}
+            found = {pageid: by_id[pageid] for pageid in params.get("pageids", "").split("|") if pageid in by_id}
+            return httpx.Response(200, json={"query": {"pages": found}})
+
+        return httpx.Response(404)
+
+
+async def simulate_session(client, fixtures, turns, stream, results):
+    city = fixtures["city"]
+    session_id = None
+    queries = fixtures["queries"]
+    offset = random.randrange(len(queries))
+    for turn in range(turns):
+        query = queries[(offset + turn) % len(queries)]["query"]
+        metadata = {"city": city, "is_first_request": turn == 0}
+        if session_id:
+            metadata["session_id"] = session_id
+        path = "/answer/stream" if stream else "/answer"
+        start = time.perf_counter()
+        first_speech = None
+        try:
+            if stream:
+                async with client.stream("POST", path, params={"query": query}, json=metadata) as response:
+                    async for line in response.aiter_lines():
+                        if first_speech is None and line == "event: speech":
+                            first_speech = time.perf_counter() - start
+                        if line == "event: error":
+                            raise RuntimeError("stream error")
+            else:
+                response = await client.post(path, params={"query": query}, json=metadata)
+                if response.status_code != 200 or "detail" in response.json():
+                    raise RuntimeError(response.text)
+            session_id = response.headers.get("x-session-id", session_id)
+            results["latency"].append(time.perf_counter() - start)
+            if first_speech is not None:
+                results["first_speech"].append(first_speech)
+        except Exception as e:
+            results["errors"].append(str(e))
+
+
+async def run(args):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    import settings
+    settings.CACHE_DB_PATH = ""
+    settings.SESSION_BACKEND = "memory"
+    if args.cold:
+        for name in ("LANDMARK_CACHE_SIZE", "WIKIPEDIA_CACHE_SIZE", "PLACE_CACHE_SIZE", "RESPONSE_CACHE_SIZE"):
+            setattr(settings, name, 0)
+
+    import main
+    import metrics
+    from agent import CityWalkAgent
+
+    with open(args.fixtures, encoding="utf-8") as f:
+        fixtures = json.load(f)
+    upstreams = Upstreams(fixtures, args.openai_latency, args.places_latency, args.wikipedia_latency, args.jitter)
+    agent = CityWalkAgent(
+        client=AsyncOpenAI(api_key="benchmark", http_client=httpx.AsyncClient(transport=httpx.MockTransport(upstreams.openai))),
+        http=httpx.AsyncClient(transport=httpx.MockTransport(upstreams.http)),
+    )
+    await main.agent.aclose()
+    main.agent = main.preference_updater.agent = main.memory.agent = agent
+
+    # collect every span, including the ones from background tasks
+    stages = defaultdict(list)
+    record_span = metrics.registry.record_span
+
+    def collect(span):
+        stages[span.name].append(span.duration)
+        record_span(span)
+
+    metrics.registry.record_span = collect
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    results = {"latency": [], "first_speech": [], "errors": []}
+    limits = httpx.Limits(max_connections=args.sessions, max_keepalive_connections=args.sessions)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            simulate_session(client, fixtures, args.turns, args.stream, results) for _ in range(args.sessions)
+        ])
+        elapsed = time.perf_counter() - start
+        # let the background preference and summary tasks finish
+        await asyncio.sleep(max(args.openai_latency, 0) * 2 / 1000)
+
+    server.should_exit = True
+    await serving
+
+    report(args, results, stages, upstreams.calls, elapsed)
+
+
+def report(args, results, stages, calls, elapsed):
+    latency = [value * 1000 for value in results["latency"]]
+    total = len(latency) + len(results["errors"])
+    print(f"sessions={args.sessions} turns={args.turns} stream={args.stream} cold={args.cold}")
+    print(f"requests={total} ok={len(latency)} errors={len(results['errors'])} elapsed={elapsed:.2f}s")
+    print(f"throughput={len(latency) / elapsed:.2f} req/s")
+    print(
+        f"latency ms: p50={percentile(latency, 50):.1f} p95={percentile(latency, 95):.1f} "
+        f"p99={percentile(latency, 99):.1f} max={max(latency, default=0):.1f}"
+    )
+    if results["first_speech"]:
+        first = [value * 1000 for value in results["first_speech"]]
+        print(f"first speech ms: p50={percentile(first, 50):.1f} p95={percentile(first, 95):.1f} p99={percentile(first, 99):.1f}")
+    print()
+    print(f"{'stage':<24}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        ms = [value * 1000 for value in durations]
+        print(
+            f"{name:<24}{len(ms):>7}{sum(ms) / len(ms):>10.1f}{percentile(ms, 50):>10.1f}"
+            f"{percentile(ms, 95):>10.1f}{percentile(ms, 99):>10.1f}"
+        )
+    print()
+    print("upstream calls: " + ", ".join(f"{name}={count}" for name, count in sorted(calls.items())))
+    for error in results["errors"][:5]:
+        print(f"error: {error[:200]}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent simulated sessions")
+    parser.add_argument("--turns", type=int, default=6, help="requests per session")
+    parser.add_argument("--stream", action="store_true", help="use /answer/stream and report time to first speech")
+    parser.add_argument("--cold", action="store_true", help="disable the landmark, Wikipedia, Places and response caches")
+    parser.add_argument("--openai-latency", type=float, default=600, help="ms per OpenAI completion")
+    parser.add_argument("--places-latency", type=float, default=150, help="ms per Google Places call")
+    parser.add_argument("--wikipedia-latency", type=float, default=200, help="ms per Wikipedia call")
+    parser.add_argument("--jitter", type=float, default=0.3, help="relative latency jitter, 0.3 = +/-30%%")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
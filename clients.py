@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+import settings
+from admission import BudgetExhaustedError, budgets
+
+logger = logging.getLogger(__name__)
+
+# worth another try: rate limited, or the upstream is briefly unavailable
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after ``failure_threshold`` failed calls in a row.
+
+    While open, calls fail immediately. After ``reset_timeout`` seconds one
+    trial call is let through (half open); its outcome closes the circuit
+    again or reopens it for another ``reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def record_abandoned(self):
+        # the caller gave up, which says nothing about the upstream; just let
+        # the next call be the half-open trial
+        self._trial = False
+
+
+class Endpoint:
+    """Call policy for one upstream API.
+
+    ``timeout`` applies to each attempt and ``deadline`` to the whole call,
+    retries included. Failed attempts are retried up to ``retries`` times
+    with jittered exponential backoff starting at ``backoff`` seconds. With
+    ``hedge_after`` set, a second identical request is sent if the first has
+    not answered within that many seconds and the faster of the two wins;
+    only use it for read-only calls. Every attempt takes one token from
+    ``budget``, a ``TokenBucket`` of calls per second.
+    """
+
+    def __init__(self, name, timeout=5.0, retries=2, backoff=0.2, hedge_after=None, breaker=None, budget=None, deadline=None):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline if deadline is not None else timeout * (retries + 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget
+
+
+class UpstreamClient:
+    """Pooled HTTP client for the Google Places and Wikipedia APIs.
+
+    Connections are kept alive and shared by every request of the process;
+    each call goes through the policy of its ``Endpoint``.
+    """
+
+    def __init__(self, http=None, endpoints=()):
+        self.http = http or httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=60.0,
+            ),
+        )
+        self.endpoints = {endpoint.name: endpoint for endpoint in endpoints}
+
+    @classmethod
+    def from_settings(cls, http=None):
+        # a call must give up on its own before the pipeline stage waiting on it
+        # does, or the failure never reaches the circuit breaker
+        if settings.UPSTREAM_DEADLINE >= settings.STAGE_TIMEOUT:
+            raise ValueError(
+                f"UPSTREAM_DEADLINE ({settings.UPSTREAM_DEADLINE}s) must be shorter than STAGE_TIMEOUT ({settings.STAGE_TIMEOUT}s)"
+            )
+        return cls(http, [
+            Endpoint(
+                "places",
+                timeout=settings.PLACES_TIMEOUT,
+                retries=settings.UPSTREAM_RETRIES,
+                backoff=settings.UPSTREAM_BACKOFF,
+                hedge_after=settings.PLACES_HEDGE_AFTER,
+                breaker=CircuitBreaker(settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RESET_TIMEOUT),
+                budget=budgets.places,
+                deadline=settings.UPSTREAM_DEADLINE,
+            ),
+            Endpoint(
+                "wikipedia",
+                timeout=settings.WIKIPEDIA_TIMEOUT,
+                retries=settings.UPSTREAM_RETRIES,
+                backoff=settings.UPSTREAM_BACKOFF,
+                hedge_after=settings.WIKIPEDIA_HEDGE_AFTER,
+                breaker=CircuitBreaker(settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RESET_TIMEOUT),
+                budget=budgets.wikipedia,
+                deadline=settings.UPSTREAM_DEADLINE,
+            ),
+        ])
+
+    async def get(self, endpoint, url, **kwargs):
+        return await self.request(endpoint, "GET", url, **kwargs)
+
+    async def post(self, endpoint, url, **kwargs):
+        return await self.request(endpoint, "POST", url, **kwargs)
+
+    async def request(self, endpoint, method, url, **kwargs):
+        """Send a request under the policy of the endpoint named ``endpoint``.
+
+        Returns the last response, which may be an error response once the
+        retries are used up. Raises ``BudgetExhaustedError`` when the
+        endpoint's budget has no call left within ``UPSTREAM_BUDGET_WAIT``,
+        ``CircuitOpenError`` when the circuit is open, and the last transport
+        error or timeout when no attempt got a response within ``deadline``.
+        """
+        policy = self.endpoints[endpoint]
+        if policy.budget is not None and not await policy.budget.take(1, settings.UPSTREAM_BUDGET_WAIT):
+            raise BudgetExhaustedError(f"{endpoint} budget exhausted")
+        if not policy.breaker.allow():
+            raise CircuitOpenError(f"{endpoint} is unavailable, circuit open")
+
+        deadline = time.monotonic() + policy.deadline
+        succeeded = False
+        cancelled = False
+        try:
+            response = None
+            error = None
+            for attempt in range(policy.retries + 1):
+                if attempt:
+                    # retries count against the budget too, but never wait for it
+                    if policy.budget is not None and not policy.budget.try_take():
+                        break
+                    # full jitter keeps retries from many workers from arriving together
+                    await asyncio.sleep(min(random.uniform(0, policy.backoff * 2 ** (attempt - 1)), deadline - time.monotonic()))
+                timeout = min(policy.timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+                try:
+                    # httpx timeouts are per phase (connect, read, ...); bound the whole attempt
+                    response = await asyncio.wait_for(self._send(policy, method, url, kwargs, timeout), timeout)
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    error, response = e, None
+                    logger.warning("%s %s attempt %d failed: %r", endpoint, method, attempt + 1, e)
+                    continue
+                if response.status_code not in RETRYABLE_STATUS:
+                    succeeded = True
+                    return response
+                logger.warning("%s %s attempt %d returned %d", endpoint, method, attempt + 1, response.status_code)
+
+            if response is None:
+                raise error or httpx.TimeoutException(f"{endpoint} gave no response within {policy.deadline}s")
+            return response
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            # a hanging upstream still ends here as a timeout, since the
+            # deadline is shorter than any stage waiting on the call
+            if succeeded:
+                policy.breaker.record_success()
+            elif cancelled:
+                policy.breaker.record_abandoned()
+            else:
+                policy.breaker.record_failure()
+
+    async def _send(self, policy, method, url, kwargs, timeout):
+        if policy.hedge_after is None:
+            return await self.http.request(method, url, timeout=timeout, **kwargs)
+
+        pending = {asyncio.ensure_future(self.http.request(method, url, timeout=timeout, **kwargs))}
+        done, _ = await asyncio.wait(pending, timeout=policy.hedge_after)
+        if not done:
+            pending.add(asyncio.ensure_future(self.http.request(method, url, timeout=timeout, **kwargs)))
+        try:
+            # the first success wins; an error only counts once both have failed
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            raise task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def openai_client(http=None):
+    """OpenAI client with its own connection pool, timeout and jittered retries."""
+    return AsyncOpenAI(
+        timeout=settings.OPENAI_TIMEOUT,
+        max_retries=settings.OPENAI_MAX_RETRIES,
+        http_client=http or httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=60.0,
+            ),
+        ),
+    )
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import re
+
+import settings
+from text import normalize_text
+
+_SECTION_HEADING = re.compile(r"^=+\s*(.*?)\s*=+$")
+# sections that rarely help a tour guide answer
+_SKIPPED_SECTIONS = {"see also", "references", "external links", "further reading", "notes", "sources", "bibliography"}
+
+
+def estimate_tokens(text):
+    # roughly 4 characters per token for English text; good enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def trim_to_tokens(text, budget):
+    if estimate_tokens(text) <= budget:
+        return text
+    cut = text[:budget * 4]
+    # prefer to stop at the end of a sentence
+    end = cut.rfind(". ")
+    if end > len(cut) // 2:
+        cut = cut[:end + 1]
+    return cut.rstrip() + " ..."
+
+
+def split_passages(article):
+    """Split a plain text Wikipedia extract into ``(section, paragraph)`` pairs."""
+    passages = []
+    section = ""
+    for block in article.split("\n"):
+        block = block.strip()
+        if not block:
+            continue
+        heading = _SECTION_HEADING.match(block)
+        if heading:
+            section = heading.group(1)
+            continue
+        if section.lower() in _SKIPPED_SECTIONS:
+            continue
+        passages.append((section, block))
+    return passages
+
+
+def select_passages(article, query, budget):
+    """Pick the passages of ``article`` most relevant to ``query`` within ``budget`` tokens.
+
+    The lead paragraph is always kept. The other passages are ranked by how
+    many query terms they (and their section title) contain, and the chosen
+    ones are returned in their original order.
+    """
+    passages = split_passages(article)
+    if not passages:
+        return ""
+    if estimate_tokens(article) <= budget:
+        return "\n".join(text for _, text in passages)
+
+    terms = set(normalize_text(query).split())
+    lead = trim_to_tokens(passages[0][1], budget)
+    chosen = {0: lead}
+    used = estimate_tokens(lead)
+
+    def score(item):
+        index, (section, text) = item
+        words = normalize_text(f"{section} {text}").split()
+        hits = sum(1 for word in words if word in terms)
+        # earlier passages are usually more general, so they win ties
+        return (hits / (len(words) ** 0.5 + 1), -index)
+
+    for index, (section, text) in sorted(enumerate(passages[1:], start=1), key=score, reverse=True):
+        cost = estimate_tokens(text)
+        if used + cost > budget:
+            continue
+        chosen[index] = text
+        used += cost
+
+    return "\n".join(chosen[index] for index in sorted(chosen))
+
+
+def compact_landmarks(landmarks, budget):
+    """Reduce the nearby landmarks to name, coordinates and rating, within ``budget`` tokens."""
+    compact = []
+    used = 0
+    for place in sorted(landmarks, key=lambda place: place['location'].get('rating', 0), reverse=True):
+        location = place['location']
+        item = {
+            "name": location['displayName']['text'],
+            "latitude": round(location['latitude'], 5),
+            "longitude": round(location['longitude'], 5),
+            "rating": location.get('rating', 0),
+        }
+        cost = estimate_tokens(json.dumps(item))
+        if used + cost > budget:
+            break
+        compact.append(item)
+        used += cost
+    return compact
+
+
+def compact_location_info(place, budget):
+    """Keep the useful parts of a Places text search result within ``budget`` tokens."""
+    if not place:
+        return None
+    info = {
+        "name": place.get('displayName', {}).get('text'),
+        "address": place.get('formattedAddress'),
+    }
+    if place.get('priceLevel'):
+        info["price_level"] = place['priceLevel']
+    summary = place.get('generativeSummary', {}).get('overview', {}).get('text')
+    if summary:
+        info["summary"] = trim_to_tokens(summary, budget // 3)
+
+    reviews = []
+    used = estimate_tokens(json.dumps(info))
+    review_budget = max(budget // 5, 20)
+    for review in place.get('reviews', []):
+        text = review.get('text', {}).get('text') or review.get('originalText', {}).get('text')
+        if not text:
+            continue
+        text = trim_to_tokens(text, review_budget)
+        cost = estimate_tokens(text)
+        if used + cost > budget:
+            break
+        reviews.append(text)
+        used += cost
+    if reviews:
+        info["reviews"] = reviews
+    return info
+
+
+def prefix_hash(messages):
+    """Digest of ``messages`` exactly as they are sent, to check the prompt prefix stays byte-identical."""
+    encoded = json.dumps(messages, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class ContextBuilder:
+    """Assembles the per-turn context for the main completion under a token budget.
+
+    Each section (nearby landmarks, location info, article text, locally
+    retrieved passages) has its own
+    budget, so the prompt stays the same size however large the upstream
+    responses are.
+    """
+
+    def __init__(self, landmarks_tokens=None, location_tokens=None, article_tokens=None, passages_tokens=None):
+        self.landmarks_tokens = landmarks_tokens or settings.CONTEXT_LANDMARKS_TOKENS
+        self.location_tokens = location_tokens or settings.CONTEXT_LOCATION_TOKENS
+        self.article_tokens = article_tokens or settings.CONTEXT_ARTICLE_TOKENS
+        self.passages_tokens = passages_tokens or settings.CONTEXT_PASSAGES_TOKENS
+
+    def landmarks(self, landmarks):
+        return compact_landmarks(landmarks, self.landmarks_tokens)
+
+    def local_passages(self, passages, article):
+        # retrieved passages, best first, skipping ones already in the article
+        chosen = []
+        used = 0
+        for passage in passages:
+            if passage in (article or ""):
+                continue
+            cost = estimate_tokens(passage)
+            if used + cost > self.passages_tokens:
+                break
+            chosen.append(passage)
+            used += cost
+        return chosen
+
+    def additional_info(self, query, intent, location_info, article, passages=()):
+        if intent['prediction']:
+            location = intent['location']
+            info = {
+                'location_info': {
+                    location: compact_location_info(location_info, self.location_tokens),
+                    'wikipedia': select_passages(article or "", f"{location} {query}", self.article_tokens),
+                }
+            }
+        else:
+            info = {'general_info': {'wikipedia': select_passages(article or "", query, self.article_tokens)}}
+        local = self.local_passages(passages, article)
+        if local:
+            info['local_knowledge'] = local
+        return info
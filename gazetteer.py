@@ -0,0 +1,129 @@
+import difflib
+import math
+import threading
+from collections import OrderedDict, defaultdict
+
+from geo import haversine_m
+from text import normalize_text
+
+# words that don't tell two place names apart
+_STOPWORDS = {"the", "of", "and", "a", "an", "at", "in", "on", "de", "la", "le", "el", "du", "des"}
+
+
+def name_tokens(name):
+    return {token for token in normalize_text(name).split() if token not in _STOPWORDS}
+
+
+class Gazetteer:
+    """In-memory index of known places for resolving names to coordinates.
+
+    Places are indexed by normalized name for exact hits and by name token
+    for fuzzy matches; a place is told apart from a namesake elsewhere by its
+    lat/lng grid cell. The index holds at most ``maxsize`` places and forgets
+    the least recently added ones first.
+    """
+
+    def __init__(self, maxsize=50000, cell_degrees=0.05):
+        self.maxsize = maxsize
+        self.cell_degrees = cell_degrees
+        self._places = OrderedDict()  # key -> place
+        self._by_name = defaultdict(set)
+        self._by_token = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_degrees)), int(math.floor(longitude / self.cell_degrees))
+
+    def add(self, name, latitude, longitude, rating=0.0):
+        normalized = normalize_text(name)
+        if not normalized:
+            return
+        cell = self._cell(latitude, longitude)
+        key = (normalized, cell)
+        place = {"displayName": name, "latitude": latitude, "longitude": longitude, "rating": rating or 0.0}
+        with self._lock:
+            if key in self._places:
+                self._places[key] = place
+                self._places.move_to_end(key)
+                return
+            self._places[key] = place
+            self._by_name[normalized].add(key)
+            for token in name_tokens(name):
+                self._by_token[token].add(key)
+            while len(self._places) > self.maxsize:
+                self._remove(next(iter(self._places)))
+
+    def add_landmarks(self, landmarks):
+        """Index the results of ``CityWalkAgent.get_nearby_landmarks``."""
+        for place in landmarks:
+            location = place['location']
+            self.add(location['displayName']['text'], location['latitude'], location['longitude'], location.get('rating', 0))
+
+    def _remove(self, key):
+        normalized, _ = key
+        self._places.pop(key)
+        self._by_name[normalized].discard(key)
+        if not self._by_name[normalized]:
+            del self._by_name[normalized]
+        for token in name_tokens(normalized):
+            self._by_token[token].discard(key)
+            if not self._by_token[token]:
+                del self._by_token[token]
+
+    def _near(self, keys, latitude, longitude, radius_m):
+        if latitude is None:
+            return keys
+        return {
+            key for key in keys
+            if haversine_m(latitude, longitude, self._places[key]['latitude'], self._places[key]['longitude']) <= radius_m
+        }
+
+    def lookup(self, name, latitude=None, longitude=None, radius_m=20000, min_score=0.9):
+        """Best match for ``name`` near the given point, or ``None``.
+
+        Exact matches win, first on the normalized name, then on its words
+        without stopwords ("The Louvre" for "Louvre"). Otherwise a candidate
+        sharing a word with ``name`` must be spelled almost the same as a
+        whole, which allows typos but not a name that merely contains the
+        other: "Central Park Zoo" is not "Central Park", and is better left
+        to a Places search.
+        """
+        normalized = normalize_text(name)
+        tokens = name_tokens(name)
+        with self._lock:
+            exact = self._near(self._by_name.get(normalized, set()), latitude, longitude, radius_m)
+            if exact:
+                return dict(self._places[self._closest(exact, latitude, longitude)])
+
+            candidates = set()
+            for token in tokens:
+                candidates |= self._by_token.get(token, set())
+            candidates = self._near(candidates, latitude, longitude, radius_m)
+
+            same_words = {key for key in candidates if name_tokens(key[0]) == tokens}
+            if tokens and same_words:
+                return dict(self._places[self._closest(same_words, latitude, longitude)])
+
+            best, best_rank = None, None
+            for key in candidates:
+                matcher = difflib.SequenceMatcher(None, normalized, key[0])
+                if matcher.real_quick_ratio() < min_score or matcher.quick_ratio() < min_score:
+                    continue
+                score = matcher.ratio()
+                if score < min_score:
+                    continue
+                # on a tie, prefer the name closest in length to the one asked for
+                rank = (score, -abs(len(key[0]) - len(normalized)))
+                if best_rank is None or rank > best_rank:
+                    best, best_rank = key, rank
+            if best is None:
+                return None
+            return dict(self._places[best])
+
+    def _closest(self, keys, latitude, longitude):
+        if latitude is None:
+            return next(iter(keys))
+        return min(keys, key=lambda key: haversine_m(latitude, longitude, self._places[key]['latitude'], self._places[key]['longitude']))
+
+    def __len__(self):
+        return len(self._places)
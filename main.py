@@ -1,8 +1,18 @@
-from fastapi import FastAPI, HTTPException
+import json
+from typing import Optional
+
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from agent import CityWalkAgent, CityWalkResponse
+import settings
+from admission import Admission, AdmissionError, budgets, upstream_limited
+from memory import ConversationMemory
+from metrics import registry, span, start_trace
+from preferences import PreferenceUpdater
+from sessions import SessionStore
 
 # 加载环境变量
 load_dotenv()
@@ -20,6 +30,15 @@ app.add_middleware(
 )
 
 agent = CityWalkAgent()
+sessions = SessionStore.from_settings()
+preference_updater = PreferenceUpdater(agent, sessions)
+memory = ConversationMemory(agent, sessions)
+admission = Admission(budgets)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await agent.aclose()
 
 class Landmark(BaseModel):
     name: str
@@ -34,19 +53,130 @@ class City(BaseModel):
 class MetaData(BaseModel):
     city: City
     is_first_request: bool
+    session_id: Optional[str] = None
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """Streams a body while holding an admission slot.
+
+    The body gives the slot back as soon as it is done; ``__call__`` makes
+    sure it is also given back when the body never runs, e.g. because the
+    client disconnected before the response started.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+async def open_session(session_id, metadata):
+    if metadata.is_first_request:
+        return await sessions.reset(session_id)
+    return await sessions.get(session_id)
+
+
+async def after_turn(session_id, background_tasks):
+    # preference inference and conversation folding don't affect this response;
+    # both stay due and run on a later turn when the OpenAI budget is low
+    if budgets.openai_low():
+        return
+    if settings.PREFERENCE_MODE == "inline":
+        await preference_updater.update(session_id)
+    else:
+        background_tasks.add_task(preference_updater.update, session_id)
+    background_tasks.add_task(memory.fold, session_id)
+
 
 @app.post("/answer", response_model=CityWalkResponse)
-async def answer(query: str, metadata: MetaData = None) -> CityWalkResponse:
+async def answer(query: str, response: Response, background_tasks: BackgroundTasks, metadata: MetaData = None) -> CityWalkResponse:
     """
     调用CityWalkAgent回答问题
     """
     try:
-        if metadata.is_first_request:
-            agent.conversation_reset()
-        return agent.answer(query, metadata, metadata.is_first_request)
+        trace = start_trace()
+        session_id = metadata.session_id or sessions.new_session_id()
+        with span("total"):
+            async with admission.admit():
+                async with sessions.lock(session_id):
+                    session = await open_session(session_id, metadata)
+                    result = await agent.answer(query, metadata, metadata.is_first_request, session)
+                    await sessions.save_turn(session)
+        await after_turn(session_id, background_tasks)
+        response.headers["X-Session-Id"] = session_id
+        if settings.TIMING_HEADERS:
+            response.headers["Server-Timing"] = trace.server_timing()
+        return result
+    except AdmissionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"Error talking to agent: {str(e)}")
-        return HTTPException(status_code=500, detail=str(e))
+        limited = upstream_limited(e, budgets)
+        if limited is not None:
+            raise HTTPException(status_code=limited.status_code, detail=limited.detail, headers={"Retry-After": str(limited.retry_after)})
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/answer/stream")
+async def answer_stream(query: str, metadata: MetaData = None) -> StreamingResponse:
+    """
+    以Server-Sent Events流式返回回答: speech片段, locations, done
+    """
+    session_id = metadata.session_id or sessions.new_session_id()
+    background_tasks = BackgroundTasks()
+    # admitted before the response starts, so a rejection can still be a 429/503
+    try:
+        await admission.acquire()
+    except AdmissionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+    release = admission.release_once()
+
+    async def events():
+        try:
+            trace = start_trace()
+            async with sessions.lock(session_id):
+                session = await open_session(session_id, metadata)
+                try:
+                    with span("total"):
+                        async for event, data in agent.answer_stream(query, metadata, metadata.is_first_request, session):
+                            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                except Exception as e:
+                    print(f"Error talking to agent: {str(e)}")
+                    # the status line is already sent, so an upstream limit travels in the event
+                    limited = upstream_limited(e, budgets)
+                    if limited is not None:
+                        error = {'status': limited.status_code, 'detail': limited.detail, 'retry_after': limited.retry_after}
+                    else:
+                        error = {'status': 500, 'detail': str(e)}
+                    yield f"event: error\ndata: {json.dumps(error)}\n\n"
+                    return
+                await sessions.save_turn(session)
+        finally:
+            release()
+        # headers are long gone by now, so the timings travel as a last event
+        if settings.TIMING_HEADERS:
+            yield f"event: timing\ndata: {json.dumps(trace.summary())}\n\n"
+        await after_turn(session_id, background_tasks)
+
+    return AdmittedStreamingResponse(
+        events(),
+        release,
+        media_type="text/event-stream",
+        headers={"X-Session-Id": session_id, "Cache-Control": "no-cache"},
+        background=background_tasks,
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """
+    Prometheus格式的各阶段耗时, 流量和token统计
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,63 @@
+import logging
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def summary_messages(session):
+    """Messages that stand in for the turns already folded into the summary."""
+    if not session.summary:
+        return []
+    return [{
+        "role": "system",
+        "content": f"SUMMARY OF THE EARLIER CONVERSATION:\n{session.summary}"
+    }]
+
+
+class ConversationMemory:
+    """Keeps each session's conversation to a rolling window of recent turns.
+
+    Once a session holds ``window_turns + fold_turns`` turns, the oldest ones
+    are folded into ``Session.summary`` so that only ``window_turns`` remain
+    verbatim. Folding in batches means the message prefix stays the same
+    between folds, and the summary is updated incrementally from the previous
+    summary and the folded turns only.
+    """
+
+    def __init__(self, agent, sessions, window_turns=None, fold_turns=None):
+        self.agent = agent
+        self.sessions = sessions
+        self.window_turns = window_turns or settings.MEMORY_WINDOW_TURNS
+        self.fold_turns = fold_turns or settings.MEMORY_FOLD_TURNS
+        self._running = set()
+
+    def is_due(self, session):
+        return len(session.conversation) // 2 >= self.window_turns + self.fold_turns
+
+    async def fold(self, session_id):
+        if session_id in self._running:
+            return
+        session = await self.sessions.get(session_id)
+        if not self.is_due(session):
+            return
+
+        self._running.add(session_id)
+        folded = session.conversation[:len(session.conversation) - 2 * self.window_turns]
+        try:
+            summary = await self.agent.summarize_conversation(session.summary, folded)
+        except Exception:
+            logger.exception("Summarizing the conversation failed for session %s", session_id)
+            return
+        finally:
+            self._running.discard(session_id)
+
+        def change(current):
+            if current is None or current.conversation_id != session.conversation_id or current.conversation[:len(folded)] != folded:
+                return None
+            current.summary = summary
+            current.conversation = current.conversation[len(folded):]
+            return current
+
+        async with self.sessions.lock(session_id):
+            await self.sessions.update(session_id, change)
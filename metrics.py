@@ -0,0 +1,169 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.bytes = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def record_usage(self, usage):
+        # ``usage`` from an OpenAI completion; may be missing on errors
+        if usage is None:
+            return
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        if details is not None:
+            self.cached_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def record_response(self, response):
+        # ``response`` from httpx
+        self.bytes += len(response.content)
+
+
+class Trace:
+    """The spans recorded while handling one request."""
+
+    def __init__(self):
+        self.spans = []
+
+    def server_timing(self):
+        """Value for a ``Server-Timing`` response header."""
+        return ", ".join(f"{span.name};dur={span.duration * 1000:.1f}" for span in self.spans)
+
+    def summary(self):
+        return [
+            {
+                "stage": span.name,
+                "ms": round(span.duration * 1000, 1),
+                "bytes": span.bytes,
+                "prompt_tokens": span.prompt_tokens,
+                "completion_tokens": span.completion_tokens,
+                "cached_tokens": span.cached_tokens,
+            }
+            for span in self.spans
+        ]
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Registry:
+    """Process-wide metrics, rendered in the Prometheus text format.
+
+    Each worker process keeps its own numbers; Prometheus sums them per instance.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)  # (metric, labels) -> Histogram
+        self.counters = defaultdict(float)  # (metric, labels) -> value
+        self.help = {}
+
+    def observe(self, metric, labels, value, help=""):
+        with self._lock:
+            self.histograms[(metric, labels)].observe(value)
+            self.help.setdefault(metric, help)
+
+    def inc(self, metric, labels, value=1, help=""):
+        with self._lock:
+            self.counters[(metric, labels)] += value
+            self.help.setdefault(metric, help)
+
+    def record_span(self, span):
+        labels = (("stage", span.name),)
+        self.observe("citywalk_stage_duration_seconds", labels, span.duration, "Wall time of each pipeline stage.")
+        if span.bytes:
+            self.inc("citywalk_stage_response_bytes_total", labels, span.bytes, "Bytes received from upstream APIs.")
+        for kind in ("prompt", "completion", "cached"):
+            tokens = getattr(span, f"{kind}_tokens")
+            if tokens:
+                self.inc(
+                    "citywalk_stage_tokens_total", labels + (("kind", kind),), tokens,
+                    "OpenAI tokens used by each stage; cached is the part of the prompt served from the prompt cache.",
+                )
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in sorted({key[0] for key in self.counters}):
+                lines.append(f"# HELP {metric} {self.help.get(metric, '')}")
+                lines.append(f"# TYPE {metric} counter")
+                for (name, labels), value in sorted(self.counters.items()):
+                    if name == metric:
+                        lines.append(f"{metric}{_labels(labels)} {value:g}")
+            for metric in sorted({key[0] for key in self.histograms}):
+                lines.append(f"# HELP {metric} {self.help.get(metric, '')}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (name, labels), histogram in sorted(self.histograms.items()):
+                    if name != metric:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{metric}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                    lines.append(f"{metric}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{metric}_sum{_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{metric}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def start_trace():
+    """Start collecting spans for the current request (and the tasks it spawns)."""
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def detach_trace():
+    """Keep the spans of the current task out of the request trace it inherited.
+
+    For background tasks that outlive the request that spawned them.
+    """
+    _current_trace.set(None)
+
+
+@contextmanager
+def span(name):
+    """Time a stage; the yielded ``Span`` can also record bytes and token usage."""
+    current = Span(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        registry.record_span(current)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(current)
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+REQUIRED = object()
+
+
+class Stage:
+    """One step of the answer pipeline.
+
+    ``func`` is an async callable that receives the results of the stages
+    named in ``deps`` as keyword arguments. A stage with a ``default`` is
+    optional: if it fails or runs past ``timeout`` the default is used and
+    the rest of the graph carries on. A stage without a default fails the
+    whole run.
+    """
+
+    def __init__(self, name, func, deps=(), timeout=None, default=REQUIRED):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.default = default
+
+
+async def run_stages(stages, fallbacks=None):
+    """Run ``stages`` as a dependency graph and return their results by name.
+
+    Every stage starts as soon as all of its dependencies have finished, so
+    independent stages run concurrently and the total latency is the
+    critical path through the graph. The names of optional stages that fell
+    back to their default are added to the ``fallbacks`` set, if given.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name!r} depends on unknown stage {dep!r}")
+
+    tasks = {}
+
+    async def run(stage):
+        kwargs = {}
+        for dep in stage.deps:
+            kwargs[dep] = await tasks[dep]
+        try:
+            return await asyncio.wait_for(stage.func(**kwargs), stage.timeout)
+        except Exception as e:
+            if stage.default is REQUIRED:
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning("Stage %s timed out after %ss", stage.name, stage.timeout)
+            else:
+                logger.warning("Stage %s failed: %s", stage.name, e)
+            if fallbacks is not None:
+                fallbacks.add(stage.name)
+            return stage.default
+
+    def start(name, visiting=()):
+        if name in tasks:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage graph has a cycle through {name!r}")
+        for dep in by_name[name].deps:
+            start(dep, visiting + (name,))
+        tasks[name] = asyncio.ensure_future(run(by_name[name]))
+
+    for stage in stages:
+        start(stage.name)
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,51 @@
+import logging
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PreferenceUpdater:
+    """Keeps each session's inferred preferences up to date off the response path.
+
+    Inference runs at most once every ``every_n_turns`` turns per session and
+    only reads the turns added since the last run, together with the
+    previously inferred ``Preferences``.
+    """
+
+    def __init__(self, agent, sessions, every_n_turns=None):
+        self.agent = agent
+        self.sessions = sessions
+        self.every_n_turns = every_n_turns or settings.PREFERENCE_EVERY_N_TURNS
+        self._running = set()
+
+    def is_due(self, session):
+        return session.turns - session.preferences_turn >= self.every_n_turns
+
+    async def update(self, session_id):
+        if session_id in self._running:
+            return
+        session = await self.sessions.get(session_id)
+        if not self.is_due(session):
+            return
+
+        self._running.add(session_id)
+        try:
+            new_turns = session.conversation[-2 * (session.turns - session.preferences_turn):]
+            preferences = await self.agent.infer_user_preferences(new_turns, session.preferences)
+        except Exception:
+            logger.exception("Preference inference failed for session %s", session_id)
+            return
+        finally:
+            self._running.discard(session_id)
+
+        # the session may have moved on while we were waiting on the model
+        def change(current):
+            if current is None or current.conversation_id != session.conversation_id or current.preferences_turn >= session.turns:
+                return None
+            current.preferences = preferences
+            current.preferences_turn = session.turns
+            return current
+
+        async with self.sessions.lock(session_id):
+            await self.sessions.update(session_id, change)
@@ -0,0 +1,145 @@
+import asyncio
+import difflib
+import logging
+import time
+from collections import OrderedDict
+
+import settings
+from admission import budgets
+from gazetteer import name_tokens
+from metrics import detach_trace
+from text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Fetches details of just-recommended locations before the visitor asks.
+
+    After a recommendation, the Places details and the Wikipedia article of
+    each recommended location are looked up in the background. A follow-up
+    question about one of them then awaits that lookup (usually finished by
+    then) instead of starting its own.
+
+    Lookups are kept per session, for at most ``max_locations`` locations of
+    the latest recommendation and ``max_sessions`` sessions. They are
+    cancelled when the session is reset or expires (unused for ``ttl``
+    seconds), when a new recommendation replaces them, or when the
+    conversation moves on to something else. A lookup is
+    skipped while its upstream budget is below ``PREFETCH_BUDGET_RESERVE``;
+    the follow-up question then does its own.
+    """
+
+    def __init__(self, agent, max_sessions=None, max_locations=None, ttl=None):
+        self.agent = agent
+        self.max_sessions = max_sessions or settings.PREFETCH_MAX_SESSIONS
+        self.max_locations = max_locations or settings.PREFETCH_MAX_LOCATIONS
+        self.ttl = ttl or settings.SESSION_TTL
+        # session id -> {"conversation_id", "tasks": {normalized name: task}, "used": monotonic time},
+        # least recently used first
+        self._sessions = OrderedDict()
+
+    def start(self, session, names, city):
+        self.cancel(session.session_id)
+        tasks = {}
+        for name in names[:self.max_locations]:
+            tasks[normalize_text(name)] = asyncio.create_task(self._fetch(name, city))
+        self._sessions[session.session_id] = {"conversation_id": session.conversation_id, "tasks": tasks, "used": time.monotonic()}
+        self._expire()
+
+    def _expire(self):
+        # the session store forgets sessions after SESSION_TTL; so do we
+        now = time.monotonic()
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - entry["used"] < self.ttl:
+                break
+            self.cancel(session_id)
+
+    async def _fetch(self, name, city):
+        # the task runs in a copy of the request's context; its spans belong
+        # to no request, not to the one that triggered it
+        detach_trace()
+        place, article = await asyncio.gather(
+            self._lookup(budgets.places, self.agent.search_location, name, city),
+            self._lookup(budgets.wikipedia, self.agent.get_wikipedia_article, name),
+            return_exceptions=True,
+        )
+        if isinstance(place, Exception):
+            logger.warning("Prefetching %s from Places failed: %s", name, place)
+            place = None
+        if isinstance(article, Exception):
+            logger.warning("Prefetching %s from Wikipedia failed: %s", name, article)
+            article = None
+        elif article:
+            await asyncio.to_thread(self.agent.retrieval.add_article, name, article, city.get('name', ''))
+        return {"place": place, "article": article}
+
+    @staticmethod
+    async def _lookup(bucket, func, *args):
+        if budgets.low(bucket, settings.PREFETCH_BUDGET_RESERVE):
+            return None
+        return await func(*args)
+
+    async def result(self, session, location):
+        """Prefetched ``{"place": ..., "article": ...}`` for ``location``, or ``None``.
+
+        Waits for a lookup still in flight. Either value is ``None`` when that
+        lookup failed or was skipped.
+        """
+        task = self._task(session, location)
+        if task is None:
+            return None
+        try:
+            # a caller giving up (stage timeout) must not cancel the shared lookup
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                return None
+            raise
+
+    def covers(self, session, location):
+        """True if ``location`` is one of the locations prefetched for ``session``."""
+        return self._task(session, location) is not None
+
+    def _task(self, session, location):
+        self._expire()
+        entry = self._sessions.get(session.session_id)
+        if entry is None:
+            return None
+        if entry["conversation_id"] != session.conversation_id:
+            # the session was reset or expired in the session store
+            self.cancel(session.session_id)
+            return None
+        task = self._match(entry["tasks"], location)
+        if task is not None:
+            entry["used"] = time.monotonic()
+            self._sessions.move_to_end(session.session_id)
+        return task
+
+    @staticmethod
+    def _match(tasks, location, min_score=0.9):
+        # the same rule as Gazetteer.lookup: the same words, or the same name
+        # but for a typo. "Central Park" is not "Central Park Zoo".
+        wanted = normalize_text(location)
+        tokens = name_tokens(location)
+        if not tokens:
+            return None
+        best, best_score = None, min_score
+        for name, task in tasks.items():
+            if name_tokens(name) == tokens:
+                return task
+            score = difflib.SequenceMatcher(None, wanted, name).ratio()
+            if score >= best_score:
+                best, best_score = task, score
+        return best
+
+    def cancel(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._cancel_tasks(entry["tasks"])
+
+    @staticmethod
+    def _cancel_tasks(tasks):
+        for task in tasks.values():
+            task.cancel()
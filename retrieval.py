@@ -0,0 +1,218 @@
+import glob
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+import numpy as np
+
+from context import estimate_tokens
+from text import normalize_text
+
+logger = logging.getLogger(__name__)
+
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "has", "have", "i", "in", "is", "it",
+    "its", "me", "my", "of", "on", "or", "so", "that", "the", "there", "this", "to", "was", "were", "what",
+    "when", "where", "which", "who", "with", "you", "your", "about", "tell", "can", "do", "some",
+}
+
+
+def tokenize(text):
+    return [token for token in normalize_text(text).split() if token not in _STOPWORDS]
+
+
+def chunk_text(text, max_tokens=150):
+    """Split ``text`` into passages of whole paragraphs of about ``max_tokens`` tokens."""
+    chunks = []
+    current = []
+    size = 0
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph or paragraph.startswith("=="):
+            continue
+        cost = estimate_tokens(paragraph)
+        if current and size + cost > max_tokens:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += cost
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def city_matches(passage_city, city):
+    if not passage_city or not city:
+        return True
+    a = set(normalize_text(passage_city).split())
+    b = set(normalize_text(city).split())
+    return a <= b or b <= a
+
+
+class BM25Index:
+    """Incremental BM25 index over short passages.
+
+    Passages are grouped by ``source`` so a whole document can be replaced
+    or evicted at once; the index keeps at most ``max_passages`` passages and
+    drops the oldest sources first, except pinned ones.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, max_passages=20000):
+        self.k1 = k1
+        self.b = b
+        self.max_passages = max_passages
+        self.passages = {}  # doc id -> passage dict
+        self.lengths = {}
+        self.postings = defaultdict(dict)  # term -> {doc id: term frequency}
+        self.sources = OrderedDict()  # source -> [doc ids]
+        self.pinned = set()
+        self.total_length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add(self, source, text, city="", max_tokens=150, pinned=False):
+        with self._lock:
+            if source in self.sources:
+                self._remove_source(source)
+            ids = []
+            for chunk in chunk_text(text, max_tokens):
+                tokens = tokenize(chunk)
+                if not tokens:
+                    continue
+                doc_id = self._next_id
+                self._next_id += 1
+                self.passages[doc_id] = {"text": chunk, "source": source, "city": city}
+                self.lengths[doc_id] = len(tokens)
+                self.total_length += len(tokens)
+                for term, count in Counter(tokens).items():
+                    self.postings[term][doc_id] = count
+                ids.append(doc_id)
+            self.sources[source] = ids
+            if pinned:
+                self.pinned.add(source)
+            evictable = [name for name in self.sources if name not in self.pinned and name != source]
+            while len(self.passages) > self.max_passages and evictable:
+                self._remove_source(evictable.pop(0))
+
+    def _remove_source(self, source):
+        for doc_id in self.sources.pop(source):
+            passage = self.passages.pop(doc_id)
+            self.total_length -= self.lengths.pop(doc_id)
+            for term in set(tokenize(passage['text'])):
+                postings = self.postings[term]
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    def search(self, query, k=5, city=""):
+        """Return up to ``k`` ``(score, passage)`` pairs, best first."""
+        terms = set(tokenize(query))
+        with self._lock:
+            if not self.passages or not terms:
+                return []
+            n = len(self.passages)
+            average_length = self.total_length / n
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                    scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            results = []
+            for doc_id, score in ranked:
+                passage = self.passages[doc_id]
+                if city_matches(passage['city'], city):
+                    results.append((score, passage))
+                    if len(results) == k:
+                        break
+            return results
+
+
+class EmbeddingIndex:
+    """Dense index over a fixed set of passages, stored as a memory-mapped ``.npy`` file.
+
+    Needs the optional ``sentence-transformers`` package; embeddings are
+    computed once per corpus and reused from ``index_dir`` afterwards.
+    """
+
+    def __init__(self, passages, model_name, index_dir):
+        from sentence_transformers import SentenceTransformer
+
+        self.passages = passages
+        self.model = SentenceTransformer(model_name, device="cpu")
+        digest = hashlib.sha1(
+            "\n".join([model_name] + [passage['text'] for passage in passages]).encode()
+        ).hexdigest()[:16]
+        path = os.path.join(index_dir, f"embeddings-{digest}.npy")
+        if not os.path.exists(path):
+            os.makedirs(index_dir, exist_ok=True)
+            vectors = self.model.encode([passage['text'] for passage in passages], normalize_embeddings=True)
+            np.save(path, np.asarray(vectors, dtype=np.float32))
+        self.vectors = np.load(path, mmap_mode="r")
+
+    def search(self, query, k=5, city=""):
+        if not self.passages:
+            return []
+        vector = self.model.encode([query], normalize_embeddings=True)[0]
+        scores = self.vectors @ vector
+        results = []
+        for doc_id in np.argsort(-scores):
+            passage = self.passages[doc_id]
+            if city_matches(passage['city'], city):
+                results.append((float(scores[doc_id]), passage))
+                if len(results) == k:
+                    break
+        return results
+
+
+class RetrievalIndex:
+    """Local passages for grounding answers: the bundled city discussions
+    plus Wikipedia articles the agent has fetched.
+
+    BM25 covers everything; when an embedding model is configured, the static
+    corpus is also searched densely and the two rankings are fused. Both
+    ``search`` and ``add_article`` are CPU bound and safe to call from worker
+    threads; async callers should run them with ``asyncio.to_thread``.
+    """
+
+    def __init__(self, corpus_dir=None, embedding_model=None, index_dir=None, max_passages=20000):
+        self.bm25 = BM25Index(max_passages=max_passages)
+        self.dense = None
+        static = []
+        for path in sorted(glob.glob(os.path.join(corpus_dir or "", "*.txt"))):
+            city = os.path.splitext(os.path.basename(path))[0].replace("_", " ")
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            source = f"corpus:{os.path.basename(path)}"
+            self.bm25.add(source, text, city, pinned=True)
+            static.extend({"text": chunk, "source": source, "city": city} for chunk in chunk_text(text))
+        if embedding_model and static:
+            try:
+                self.dense = EmbeddingIndex(static, embedding_model, index_dir or ".")
+            except ImportError:
+                logger.warning("sentence-transformers is not installed, using BM25 only")
+
+    def add_article(self, title, text, city=""):
+        source = f"wikipedia:{normalize_text(title)}"
+        if text and source not in self.bm25.sources:
+            self.bm25.add(source, text, city)
+
+    def search(self, query, city="", k=5):
+        """Top ``k`` passages for ``query`` about ``city``, as plain strings."""
+        ranked = self.bm25.search(query, k, city)
+        if self.dense is None:
+            return [passage['text'] for _, passage in ranked]
+
+        # reciprocal rank fusion of the sparse and dense rankings
+        fused = defaultdict(float)
+        for results in (ranked, self.dense.search(query, k, city)):
+            for rank, (_, passage) in enumerate(results):
+                fused[passage['text']] += 1 / (60 + rank)
+        return sorted(fused, key=fused.get, reverse=True)[:k]
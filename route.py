@@ -0,0 +1,101 @@
+import numpy as np
+
+from geo import EARTH_RADIUS_M
+
+
+def distance_matrix(latitudes, longitudes):
+    """Pairwise haversine distances in metres, as an ``(n, n)`` array."""
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lng = np.radians(np.asarray(longitudes, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlng = lng[:, None] - lng[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def path_length(order, dist):
+    order = np.asarray(order)
+    return float(dist[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbour(dist):
+    """Greedy open path from node 0 that always walks to the closest unvisited node."""
+    n = len(dist)
+    order = [0]
+    unvisited = set(range(1, n))
+    while unvisited:
+        last = order[-1]
+        nearest = min(unvisited, key=lambda node: dist[last, node])
+        order.append(nearest)
+        unvisited.remove(nearest)
+    return order
+
+
+def two_opt(order, dist):
+    """Reverse segments of the path while that makes it shorter. Node 0 stays first."""
+    order = list(order)
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            for k in range(i + 1, n):
+                a, b = order[i - 1], order[i]
+                c = order[k]
+                # the path is open, so reversing up to the last stop has no edge after it
+                after = dist[c, order[k + 1]] if k + 1 < n else 0.0
+                new_after = dist[b, order[k + 1]] if k + 1 < n else 0.0
+                delta = dist[a, c] + new_after - dist[a, b] - after
+                if delta < -1e-9:
+                    order[i:k + 1] = reversed(order[i:k + 1])
+                    improved = True
+    return order
+
+
+def or_opt(order, dist, max_segment=3):
+    """Move runs of up to ``max_segment`` stops elsewhere in the path while that makes it shorter."""
+    order = list(order)
+    best = path_length(order, dist)
+    improved = True
+    while improved:
+        improved = False
+        for size in range(1, max_segment + 1):
+            for start in range(1, len(order) - size + 1):
+                segment = order[start:start + size]
+                rest = order[:start] + order[start + size:]
+                for position in range(1, len(rest) + 1):
+                    if position == start:
+                        continue
+                    for candidate_segment in (segment, segment[::-1]):
+                        candidate = rest[:position] + candidate_segment + rest[position:]
+                        length = path_length(candidate, dist)
+                        if length < best - 1e-9:
+                            order, best = candidate, length
+                            improved = True
+                            break
+                    if improved:
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+    return order
+
+
+def plan_route(start, stops, walking_speed_kmh=4.8):
+    """Order ``stops`` into a short walk beginning at ``start``.
+
+    ``start`` and every stop are dicts with ``latitude`` and ``longitude``.
+    Returns ``(ordered_stops, distance_meters, duration_minutes)`` for an open
+    walk from the start through every stop, without returning.
+    """
+    if not stops:
+        return [], 0.0, 0.0
+    points = [start] + list(stops)
+    dist = distance_matrix([p['latitude'] for p in points], [p['longitude'] for p in points])
+    order = nearest_neighbour(dist)
+    if len(stops) > 2:
+        order = or_opt(two_opt(order, dist), dist)
+    distance = path_length(order, dist)
+    minutes = distance / (walking_speed_kmh * 1000 / 60)
+    return [stops[node - 1] for node in order[1:]], round(distance, 1), round(minutes, 1)
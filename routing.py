@@ -0,0 +1,62 @@
+import json
+
+import settings
+
+# cheaper, faster models the stages can be routed to, by tier name
+MODEL_TIERS = {
+    "flagship": settings.MODEL_FLAGSHIP,
+    "fast": settings.MODEL_FAST,
+}
+
+# the guide's answer stays on the flagship model; the stages that only
+# classify, extract or summarize get the fast tier and tight token limits
+DEFAULT_ROUTES = {
+    "main_completion": {"model": "flagship", "max_tokens": 4000, "temperature": 1.0},
+    "analysis": {"model": "fast", "max_tokens": 200, "temperature": 0.0},
+    "preference_inference": {"model": "fast", "max_tokens": 600, "temperature": 0.0},
+    "conversation_summary": {"model": "fast", "max_tokens": 600, "temperature": 0.3},
+}
+
+
+class ModelRoute:
+    def __init__(self, model, max_tokens, temperature=1.0, top_p=1.0):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+
+    def params(self):
+        """Keyword arguments for a chat completion call."""
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+        }
+
+
+class ModelRouter:
+    """Which model, token limit and temperature each completion stage uses.
+
+    ``routes`` maps a stage name to a dict of ``ModelRoute`` arguments; a
+    ``model`` that names a tier in ``tiers`` is replaced by that tier's model.
+    """
+
+    def __init__(self, routes, tiers=None):
+        self.tiers = tiers or MODEL_TIERS
+        self.routes = {}
+        for stage, route in routes.items():
+            route = dict(route)
+            route["model"] = self.tiers.get(route["model"], route["model"])
+            self.routes[stage] = ModelRoute(**route)
+
+    @classmethod
+    def from_settings(cls):
+        # MODEL_ROUTES overrides individual fields, e.g. {"analysis": {"model": "flagship"}}
+        routes = {stage: dict(route) for stage, route in DEFAULT_ROUTES.items()}
+        for stage, override in json.loads(settings.MODEL_ROUTES or "{}").items():
+            routes.setdefault(stage, dict(DEFAULT_ROUTES["main_completion"])).update(override)
+        return cls(routes)
+
+    def params(self, stage):
+        return self.routes[stage].params()
@@ -0,0 +1,135 @@
+import asyncio
+import uuid
+import weakref
+from typing import Optional
+
+import pydantic
+
+import settings
+from cache import SQLiteCache, TTLCache
+
+
+class Session(pydantic.BaseModel):
+    session_id: str
+    # changes whenever the session is reset, so late background work for
+    # an earlier conversation can tell it is stale
+    conversation_id: str = pydantic.Field(default_factory=lambda: uuid.uuid4().hex)
+    language: str = "English"
+    # the most recent turns verbatim; older ones are folded into summary
+    conversation: list[dict] = []
+    summary: str = ""
+    turns: int = 0
+    preferences: Optional[dict] = None
+    preferences_turn: int = 0
+    # size and digest of the stable prompt prefix sent last turn, see CityWalkAgent.check_prefix
+    prefix_messages: int = 0
+    prefix_hash: str = ""
+    # bumped on every save, to tell whether someone else saved since this copy was read
+    version: int = 0
+
+
+class SessionStore:
+    """Per-session conversation state, keyed by session id.
+
+    The backend is any cache with ``get`` and ``update`` (see ``cache.py``).
+    Sessions are stored as plain dicts so the same store works in-process
+    and through a SQLite file shared by several workers. Every write is a
+    read-modify-write through ``update``, so a worker never overwrites what
+    another one saved in the meantime.
+    """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = TTLCache(maxsize=settings.SESSION_MAX_SESSIONS, ttl=settings.SESSION_TTL)
+        self.backend = backend
+        self._locks = weakref.WeakValueDictionary()
+
+    @classmethod
+    def from_settings(cls):
+        if settings.SESSION_BACKEND == "sqlite":
+            backend = SQLiteCache(
+                settings.SESSION_DB_PATH,
+                table="sessions",
+                maxsize=settings.SESSION_MAX_SESSIONS,
+                ttl=settings.SESSION_TTL,
+            )
+        elif settings.SESSION_BACKEND == "memory":
+            backend = None
+        else:
+            raise ValueError(f"Unknown session backend: {settings.SESSION_BACKEND}")
+        return cls(backend)
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def lock(self, session_id):
+        # serializes turns of one session inside this worker; different
+        # sessions never wait on each other. Other workers are kept in
+        # check by ``update`` instead.
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[session_id] = lock
+        return lock
+
+    async def _call(self, func, *args):
+        # a SQLite call may wait for another worker's write lock; keep that
+        # wait off the event loop
+        if isinstance(self.backend, SQLiteCache):
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    async def get(self, session_id):
+        data = await self._call(self.backend.get, session_id)
+        if data is None:
+            return Session(session_id=session_id)
+        return Session.parse_obj(data)
+
+    async def update(self, session_id, change):
+        """Apply ``change`` to the stored session, atomically across workers.
+
+        ``change`` gets the current session (``None`` if there is none) and
+        returns the session to store, or ``None`` to leave it as it is. With
+        the SQLite backend it runs in a worker thread, so it must not touch
+        the event loop. Returns what was stored, or ``None``.
+        """
+        def apply(data):
+            current = None if data is None else Session.parse_obj(data)
+            updated = change(current)
+            if updated is None:
+                return None
+            updated.version = (current.version if current else 0) + 1
+            return updated.dict()
+
+        data = await self._call(self.backend.update, session_id, apply)
+        return None if data is None else Session.parse_obj(data)
+
+    async def save_turn(self, session):
+        """Store ``session`` after a turn added its query and answer to it.
+
+        If another worker saved the session since it was read, e.g. a
+        conversation fold or a preference update, the turn's two new messages
+        are added to that version instead of overwriting it. A turn of a
+        conversation that has been reset meanwhile is dropped.
+        """
+        def change(current):
+            if current is None or (current.conversation_id, current.version) == (session.conversation_id, session.version):
+                return session
+            if current.conversation_id != session.conversation_id:
+                return None
+            current.conversation = current.conversation + session.conversation[-2:]
+            current.turns += 1
+            current.language = session.language
+            current.prefix_messages = session.prefix_messages
+            current.prefix_hash = session.prefix_hash
+            return current
+
+        stored = await self.update(session.session_id, change)
+        if stored is not None:
+            session.version = stored.version
+
+    async def reset(self, session_id):
+        # stored straight away, so a turn of the old conversation still in
+        # flight elsewhere can tell it has been replaced
+        return await self.update(session_id, lambda current: Session(session_id=session_id))
@@ -0,0 +1,132 @@
+import os
+
+from dotenv import load_dotenv
+
+# load the .env file before anything reads the environment
+load_dotenv()
+
+# session store: "memory" keeps sessions inside the worker process,
+# "sqlite" shares them between workers through a local database file
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1024"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+
+# seconds an optional pipeline stage (Places, Wikipedia) may take before the
+# answer goes ahead without it
+STAGE_TIMEOUT = float(os.getenv("STAGE_TIMEOUT", "10"))
+
+# "deferred" infers visitor preferences after the response has been sent,
+# "inline" waits for them before responding
+PREFERENCE_MODE = os.getenv("PREFERENCE_MODE", "deferred")
+# re-infer preferences at most once every N turns of a session
+PREFERENCE_EVERY_N_TURNS = int(os.getenv("PREFERENCE_EVERY_N_TURNS", "3"))
+
+# shared by the persistent caches below; leave empty to keep them in memory only
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "")
+
+# nearby landmarks are cached per geohash cell of the city centre
+LANDMARK_CACHE_PRECISION = int(os.getenv("LANDMARK_CACHE_PRECISION", "6"))
+LANDMARK_CACHE_SIZE = int(os.getenv("LANDMARK_CACHE_SIZE", "2048"))
+LANDMARK_CACHE_TTL = float(os.getenv("LANDMARK_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Wikipedia search results and article extracts
+WIKIPEDIA_CACHE_SIZE = int(os.getenv("WIKIPEDIA_CACHE_SIZE", "1024"))
+WIKIPEDIA_CACHE_TTL = float(os.getenv("WIKIPEDIA_CACHE_TTL", str(24 * 3600)))
+
+# token budgets for each section of the per-turn context
+CONTEXT_LANDMARKS_TOKENS = int(os.getenv("CONTEXT_LANDMARKS_TOKENS", "400"))
+CONTEXT_LOCATION_TOKENS = int(os.getenv("CONTEXT_LOCATION_TOKENS", "400"))
+CONTEXT_ARTICLE_TOKENS = int(os.getenv("CONTEXT_ARTICLE_TOKENS", "1200"))
+CONTEXT_PASSAGES_TOKENS = int(os.getenv("CONTEXT_PASSAGES_TOKENS", "400"))
+
+# turns kept verbatim in the conversation; older ones are folded into a running
+# summary, MEMORY_FOLD_TURNS at a time. Keep the window at least as large as
+# PREFERENCE_EVERY_N_TURNS so preference inference sees every turn.
+MEMORY_WINDOW_TURNS = int(os.getenv("MEMORY_WINDOW_TURNS", "6"))
+MEMORY_FOLD_TURNS = int(os.getenv("MEMORY_FOLD_TURNS", "4"))
+
+# Places text search results, keyed by location name and area
+PLACE_CACHE_SIZE = int(os.getenv("PLACE_CACHE_SIZE", "4096"))
+PLACE_CACHE_TTL = float(os.getenv("PLACE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# known places used to resolve recommended location names to coordinates
+GAZETTEER_SIZE = int(os.getenv("GAZETTEER_SIZE", "50000"))
+GAZETTEER_RADIUS_M = float(os.getenv("GAZETTEER_RADIUS_M", "20000"))
+
+# used to estimate the duration of recommended walks
+WALKING_SPEED_KMH = float(os.getenv("WALKING_SPEED_KMH", "4.8"))
+
+# local retrieval over the bundled city discussions and fetched articles;
+# set RETRIEVAL_EMBEDDING_MODEL (needs sentence-transformers) to add a dense index
+RETRIEVAL_CORPUS_DIR = os.getenv("RETRIEVAL_CORPUS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "reddit_discussions"))
+RETRIEVAL_EMBEDDING_MODEL = os.getenv("RETRIEVAL_EMBEDDING_MODEL", "")
+RETRIEVAL_INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", ".retrieval_index")
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+
+# answers to information questions, shared by everyone asking the same
+# question about the same place in the same language from the same area
+# (geohash cell)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(6 * 3600)))
+RESPONSE_CACHE_PRECISION = int(os.getenv("RESPONSE_CACHE_PRECISION", "5"))
+
+# upstream calls: connection pool, per-attempt timeouts in seconds, retries
+# with jittered backoff, and a circuit breaker per upstream. Set a
+# *_HEDGE_AFTER (seconds) to send a second request when the first is slow.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+PLACES_TIMEOUT = float(os.getenv("PLACES_TIMEOUT", "5"))
+WIKIPEDIA_TIMEOUT = float(os.getenv("WIKIPEDIA_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", "0.2"))
+# total seconds for one upstream call including its retries; must stay below
+# STAGE_TIMEOUT so that the circuit breaker sees calls that time out
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+PLACES_HEDGE_AFTER = float(os.getenv("PLACES_HEDGE_AFTER")) if os.getenv("PLACES_HEDGE_AFTER") else None
+WIKIPEDIA_HEDGE_AFTER = float(os.getenv("WIKIPEDIA_HEDGE_AFTER")) if os.getenv("WIKIPEDIA_HEDGE_AFTER") else None
+
+# admission control: requests handled at once, how many more may wait for a
+# slot and for how long before getting a 503
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+# upstream quotas per worker process, 0 for no limit; set them to your share
+# of the account limits. A Places or Wikipedia call waits at most
+# UPSTREAM_BUDGET_WAIT seconds for its budget and is skipped otherwise, and
+# preference inference and summaries are deferred while less than
+# OPENAI_BACKGROUND_RESERVE of the OpenAI budget is left.
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+PLACES_QPS = float(os.getenv("PLACES_QPS", "0"))
+WIKIPEDIA_QPS = float(os.getenv("WIKIPEDIA_QPS", "0"))
+UPSTREAM_BUDGET_WAIT = float(os.getenv("UPSTREAM_BUDGET_WAIT", "0.5"))
+OPENAI_BACKGROUND_RESERVE = float(os.getenv("OPENAI_BACKGROUND_RESERVE", "0.2"))
+
+# after a recommendation, look up the Places details and Wikipedia article of
+# the recommended locations in the background, for likely follow-up questions
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1").lower() in ("1", "true", "yes")
+PREFETCH_MAX_LOCATIONS = int(os.getenv("PREFETCH_MAX_LOCATIONS", "5"))
+PREFETCH_MAX_SESSIONS = int(os.getenv("PREFETCH_MAX_SESSIONS", "256"))
+# skip a prefetch lookup while less than this fraction of the Places or
+# Wikipedia budget is left, keeping it for the questions visitors do ask
+PREFETCH_BUDGET_RESERVE = float(os.getenv("PREFETCH_BUDGET_RESERVE", "0.5"))
+
+# model tiers the completion stages are routed to (see routing.py); MODEL_ROUTES
+# is JSON overriding the per-stage routes, e.g.
+# {"analysis": {"model": "flagship", "max_tokens": 300}}
+MODEL_FLAGSHIP = os.getenv("MODEL_FLAGSHIP", "gpt-4o")
+MODEL_FAST = os.getenv("MODEL_FAST", "gpt-4o-mini")
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+
+# decide the language of each query locally from its script and common words,
+# falling back to the model only when the text is ambiguous; when off, only
+# scripts written in a single language (Greek, Thai, ...) skip the model
+LOCAL_LANGUAGE_DETECTION = os.getenv("LOCAL_LANGUAGE_DETECTION", "1").lower() in ("1", "true", "yes")
+
+# add a Server-Timing header (or a final "timing" event when streaming) with
+# the duration of each stage of the request
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "0").lower() in ("1", "true", "yes")
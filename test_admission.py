@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from admission import Admission, AdmissionError, Budgets, TokenBucket, upstream_limited
+
+
+def test_bucket_without_rate_is_unlimited():
+    bucket = TokenBucket(0)
+    assert all(bucket.try_take() for _ in range(1000))
+    assert bucket.wait_time(10) == 0.0
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(100, capacity=2)
+    assert bucket.try_take() and bucket.try_take()
+    assert not bucket.try_take()
+    time.sleep(0.05)
+    assert bucket.level() == pytest.approx(2)
+
+
+def test_bucket_take_waits_only_within_timeout():
+    async def run():
+        bucket = TokenBucket(20, capacity=1)
+        assert bucket.try_take()
+        assert not await bucket.take(1, timeout=0.01)
+        start = time.monotonic()
+        assert await bucket.take(1, timeout=0.2)
+        assert time.monotonic() - start == pytest.approx(0.05, abs=0.03)
+
+    asyncio.run(run())
+
+
+def test_charge_puts_bucket_in_debt():
+    bucket = TokenBucket(10, capacity=10)
+    bucket.charge(25)
+    assert bucket.level() < 0
+    assert not bucket.try_take()
+    assert bucket.wait_time() == pytest.approx(1.6, abs=0.05)
+
+
+def test_openai_low_below_reserve(monkeypatch):
+    import settings
+
+    monkeypatch.setattr(settings, "OPENAI_BACKGROUND_RESERVE", 0.2)
+    budgets = Budgets(openai_tokens_per_minute=1000, places_qps=0, wikipedia_qps=0)
+    assert not budgets.openai_low()
+    budgets.openai.charge(850)
+    assert budgets.openai_low()
+    assert not Budgets(0, 0, 0).openai_low()
+
+
+def test_admission_queues_then_rejects():
+    async def run():
+        admission = Admission(Budgets(0, 0, 0), max_in_flight=1, max_queue=1, queue_timeout=0.05)
+        await admission.acquire()
+
+        # one request may wait for the slot, but not past the queue timeout
+        with pytest.raises(AdmissionError) as timed_out:
+            await admission.acquire()
+        assert timed_out.value.status_code == 503
+
+        waiter = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionError) as full:
+            await admission.acquire()
+        assert full.value.status_code == 503 and full.value.retry_after == 1
+
+        admission.release()
+        await waiter
+        assert admission.in_flight == 1 and admission.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_admission_rejects_while_openai_budget_in_debt():
+    async def run():
+        budgets = Budgets(openai_tokens_per_minute=600, places_qps=0, wikipedia_qps=0)
+        budgets.openai.charge(900)
+        admission = Admission(budgets, max_in_flight=4)
+        with pytest.raises(AdmissionError) as rejected:
+            await admission.acquire()
+        assert rejected.value.status_code == 429
+        assert rejected.value.retry_after == 31
+        assert admission.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_admit_releases_on_error():
+    async def run():
+        admission = Admission(Budgets(0, 0, 0), max_in_flight=1)
+        with pytest.raises(RuntimeError):
+            async with admission.admit():
+                raise RuntimeError("boom")
+        assert admission.in_flight == 0
+        async with admission.admit():
+            assert admission.in_flight == 1
+
+    asyncio.run(run())
+
+
+def rate_limited(headers):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return openai.RateLimitError("rate limited", response=httpx.Response(429, headers=headers, request=request), body=None)
+
+
+def test_upstream_limits_map_to_retryable_statuses():
+    budgets = Budgets(openai_tokens_per_minute=600, places_qps=0, wikipedia_qps=0)
+    assert upstream_limited(rate_limited({"retry-after": "7"}), budgets).retry_after == 7
+    assert upstream_limited(rate_limited({"retry-after-ms": "1500"}), budgets).retry_after == 2
+
+    budgets.openai.charge(900)
+    limited = upstream_limited(rate_limited({}), budgets)
+    assert (limited.status_code, limited.retry_after) == (429, 31)
+
+    timeout = openai.APITimeoutError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    assert upstream_limited(timeout, budgets).status_code == 503
+    assert upstream_limited(RuntimeError("boom"), budgets) is None
@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+import pytest
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+
+from agent import CityWalkAgent
+from sessions import Session
+
+
+def client(parse):
+    return SimpleNamespace(beta=SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=parse))))
+
+
+def truncated_completion():
+    return ChatCompletion.construct(
+        id="c1", object="chat.completion", created=0, model="test",
+        choices=[{"index": 0, "finish_reason": "length", "message": {"role": "assistant", "content": '{"language": "Eng'}}],
+        usage=CompletionUsage(prompt_tokens=100, completion_tokens=50, total_tokens=150),
+    )
+
+
+def refused(**kwargs):
+    message = SimpleNamespace(refusal="I can't help with that", dict=lambda: {"parsed": None})
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+@pytest.mark.parametrize("parse", [
+    lambda **kwargs: (_ for _ in ()).throw(openai.LengthFinishReasonError(completion=truncated_completion())),
+    lambda **kwargs: (_ for _ in ()).throw(openai.OpenAIError("no connection")),
+    refused,
+])
+def test_analysis_falls_back_when_the_model_gives_no_analysis(parse):
+    async def fake_parse(**kwargs):
+        return parse(**kwargs)
+
+    agent = CityWalkAgent(client=client(fake_parse))
+    session = Session(session_id="s1", language="English")
+    analysis = asyncio.run(agent.analyze_turn("Tell me about the Louvre", session))
+    assert analysis["normalized_query"] == "Tell me about the Louvre"
+    assert analysis["prediction"] is False
+    assert analysis["language"] == "English"
+
+
+def analysis_client(language, seen):
+    async def parse(**kwargs):
+        seen.append(kwargs["messages"][0]["content"])
+        parsed = {"language": language, "normalized_query": "q", "prediction": False, "location": ""}
+        message = SimpleNamespace(refusal=None, dict=lambda: {"parsed": parsed})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+    return client(parse)
+
+
+@pytest.mark.parametrize("query, language", [
+    ("Dime más sobre el parque", "Spanish"),
+    ("Parlez-moi du musée", "French"),
+])
+def test_undecided_latin_query_lets_the_model_notice_a_language_switch(query, language):
+    seen = []
+    agent = CityWalkAgent(client=analysis_client(language, seen))
+    session = Session(session_id="s1", language="English", turns=3)
+    analysis = asyncio.run(agent.analyze_turn(query, session))
+    assert analysis["language"] == language
+    assert "KNOWN LANGUAGE:\n            unknown" in seen[0]
+
+
+def test_without_local_detection_the_model_decides(monkeypatch):
+    import settings
+
+    monkeypatch.setattr(settings, "LOCAL_LANGUAGE_DETECTION", False)
+    seen = []
+    agent = CityWalkAgent(client=analysis_client("Spanish", seen))
+    session = Session(session_id="s1", language="English", turns=3)
+    assert asyncio.run(agent.analyze_turn("Dime más sobre el parque", session))["language"] == "Spanish"
+    assert "KNOWN LANGUAGE:\n            unknown" in seen[0]
+    # a script written in a single language still settles it
+    assert asyncio.run(agent.analyze_turn("เล่าเรื่องวัดนี้ให้ฟังหน่อย", session))["language"] == "Thai"
+
+
+def test_wikipedia_article_refetched_by_pageid_once_its_extract_is_evicted():
+    import httpx
+
+    requests = []
+
+    def wikipedia(request):
+        requests.append(dict(request.url.params))
+        if "gsrsearch" in request.url.params:
+            return httpx.Response(200, json={"query": {"pages": {"42": {"pageid": 42, "extract": "Louvre, first fetch"}}}})
+        return httpx.Response(200, json={"query": {"pages": {"42": {"pageid": 42, "extract": "Louvre, by pageid"}}}})
+
+    async def run():
+        agent = CityWalkAgent(client=SimpleNamespace(), http=httpx.AsyncClient(transport=httpx.MockTransport(wikipedia)))
+        assert await agent.get_wikipedia_article("The Louvre") == "Louvre, first fetch"
+        agent.wikipedia_article_cache.clear()
+        assert await agent.get_wikipedia_article("the louvre") == "Louvre, by pageid"
+        assert await agent.get_wikipedia_article("The Louvre") == "Louvre, by pageid"
+        await agent.http.aclose()
+
+    asyncio.run(run())
+    assert len(requests) == 2
+    assert requests[1]["pageids"] == "42"
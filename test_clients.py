@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from clients import CircuitBreaker, CircuitOpenError, Endpoint, UpstreamClient
+
+
+async def hang(request):
+    await asyncio.sleep(3600)
+
+
+def client(handler, **policy):
+    policy.setdefault("breaker", CircuitBreaker(failure_threshold=2, reset_timeout=0.05))
+    return UpstreamClient(httpx.AsyncClient(transport=httpx.MockTransport(handler)), [Endpoint("places", **policy)])
+
+
+def test_breaker_opens_after_threshold_and_half_opens():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()  # a single trial at a time
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+
+
+def test_hanging_upstream_gives_up_within_deadline_and_opens_circuit():
+    async def run():
+        upstream = client(hang, timeout=0.05, retries=5, backoff=0.0, deadline=0.12)
+        for _ in range(2):
+            start = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                # the stage waiting on the call allows more than the deadline
+                await asyncio.wait_for(upstream.get("places", "https://places.test/"), 1.0)
+            assert time.monotonic() - start < 0.5
+        with pytest.raises(CircuitOpenError):
+            await upstream.get("places", "https://places.test/")
+
+    asyncio.run(run())
+
+
+def test_cancelled_call_is_not_a_failure():
+    async def run():
+        upstream = client(hang, timeout=5.0)
+        breaker = upstream.endpoints["places"].breaker
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(upstream.get("places", "https://places.test/"), 0.05)
+        assert breaker.failures == 0
+        assert breaker.state == "closed"
+
+    asyncio.run(run())
+
+
+def test_cancelled_half_open_trial_is_released():
+    async def run():
+        upstream = client(hang, timeout=5.0)
+        breaker = upstream.endpoints["places"].breaker
+        breaker.record_failure()
+        breaker.record_failure()
+        await asyncio.sleep(0.06)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(upstream.get("places", "https://places.test/"), 0.05)
+        assert breaker.state == "half_open"
+        assert breaker.allow()  # the next call is the trial
+
+    asyncio.run(run())
+
+
+def test_retries_on_retryable_status():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503 if len(calls) == 1 else 200)
+
+    async def run():
+        upstream = client(handler, backoff=0.0)
+        response = await upstream.get("places", "https://places.test/")
+        assert response.status_code == 200
+        assert len(calls) == 2
+        assert upstream.endpoints["places"].breaker.failures == 0
+
+    asyncio.run(run())
+
+
+def test_deadline_must_be_shorter_than_stage_timeout(monkeypatch):
+    import settings
+
+    monkeypatch.setattr(settings, "UPSTREAM_DEADLINE", settings.STAGE_TIMEOUT)
+    with pytest.raises(ValueError):
+        UpstreamClient.from_settings()
@@ -0,0 +1,56 @@
+from gazetteer import Gazetteer
+
+NYC = (40.7580, -73.9855)
+
+
+def gazetteer():
+    places = Gazetteer()
+    places.add("Central Park Zoo", 40.7678, -73.9718)
+    places.add("Brooklyn Bridge Park", 40.7003, -73.9967)
+    places.add("Metropolitan Museum of Art", 40.7794, -73.9632)
+    places.add("The Louvre", 48.8606, 2.3376)
+    return places
+
+
+def test_exact_name_wins():
+    place = gazetteer().lookup("central park zoo", *NYC)
+    assert place["displayName"] == "Central Park Zoo"
+
+
+def test_exact_after_stopwords():
+    place = gazetteer().lookup("Louvre", 48.8566, 2.3522)
+    assert place["displayName"] == "The Louvre"
+
+
+def test_typo_matches():
+    place = gazetteer().lookup("Metropolitan Musuem of Art", *NYC)
+    assert place["displayName"] == "Metropolitan Museum of Art"
+
+
+def test_contained_name_is_a_different_place():
+    places = gazetteer()
+    assert places.lookup("Central Park", *NYC) is None
+    assert places.lookup("Brooklyn Bridge", *NYC) is None
+    assert places.lookup("Park", *NYC) is None
+
+
+def test_prefers_name_closest_in_length():
+    places = Gazetteer()
+    places.add("Museum of Art", *NYC)
+    places.add("Museum of Arts and Design", *NYC)
+    assert places.lookup("Museum of Arts", *NYC)["displayName"] == "Museum of Art"
+
+
+def test_only_places_within_radius():
+    places = gazetteer()
+    assert places.lookup("The Louvre", *NYC, radius_m=20000) is None
+    assert places.lookup("The Louvre")["displayName"] == "The Louvre"
+
+
+def test_forgets_oldest_places():
+    places = Gazetteer(maxsize=2)
+    places.add("Central Park Zoo", 40.7678, -73.9718)
+    places.add("Brooklyn Bridge Park", 40.7003, -73.9967)
+    places.add("The Louvre", 48.8606, 2.3376)
+    assert len(places) == 2
+    assert places.lookup("Central Park Zoo") is None
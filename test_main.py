@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+from admission import Admission, Budgets
+from main import AdmittedStreamingResponse
+
+
+def admission():
+    return Admission(Budgets(0, 0, 0), max_in_flight=1, max_queue=0, queue_timeout=0.05)
+
+
+def test_slot_released_once_after_stream():
+    slots = admission()
+    sent = []
+
+    async def run():
+        await slots.acquire()
+        release = slots.release_once()
+
+        async def body():
+            try:
+                yield "data: 1\n\n"
+            finally:
+                release()
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST", "path": "/", "headers": []}
+
+        async def receive():
+            await asyncio.sleep(3600)
+
+        await AdmittedStreamingResponse(body(), release)(scope, receive, send)
+        assert slots.in_flight == 0
+        await slots.acquire()  # the single slot is free again, and only once
+        assert slots.in_flight == 1
+
+    asyncio.run(run())
+    assert sent[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
+
+
+def test_slot_released_when_body_never_starts():
+    slots = admission()
+
+    async def run():
+        await slots.acquire()
+        release = slots.release_once()
+        started = False
+
+        async def body():
+            nonlocal started
+            started = True
+            yield "data: 1\n\n"
+
+        async def send(message):
+            raise OSError("client went away")
+
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}, "method": "POST", "path": "/", "headers": []}
+
+        async def receive():
+            await asyncio.sleep(3600)
+
+        with pytest.raises(ClientDisconnect):
+            await AdmittedStreamingResponse(body(), release)(scope, receive, send)
+        assert not started
+        assert slots.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_openai_rate_limit_is_a_429_with_retry_after(monkeypatch):
+    import httpx
+    import openai
+    from fastapi.testclient import TestClient
+
+    import main
+
+    async def answer(*args, **kwargs):
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        raise openai.RateLimitError("rate limited", response=httpx.Response(429, headers={"retry-after": "12"}, request=request), body=None)
+
+    monkeypatch.setattr(main.agent, "answer", answer)
+    metadata = {"city": {"name": "New York", "latitude": 40.758, "longitude": -73.9855}, "is_first_request": True}
+    response = TestClient(main.app).post("/answer", params={"query": "hi"}, json=metadata)
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "12"
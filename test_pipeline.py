@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from pipeline import Stage, run_stages
+
+
+def test_fallbacks_name_the_stages_that_used_their_default():
+    async def ok():
+        return "ok"
+
+    async def fail():
+        raise RuntimeError("upstream down")
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    fallbacks = set()
+    results = asyncio.run(run_stages([
+        Stage("ok", ok, default=None),
+        Stage("failed", fail, default=""),
+        Stage("slow", slow, timeout=0.01, default=""),
+    ], fallbacks))
+    assert results == {"ok": "ok", "failed": "", "slow": ""}
+    assert fallbacks == {"failed", "slow"}
+
+
+def test_independent_stages_run_concurrently():
+    async def wait():
+        await asyncio.sleep(0.05)
+        return 1
+
+    async def add(a, b):
+        return a + b
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        results = await run_stages([Stage("a", wait), Stage("b", wait), Stage("sum", add, deps=["a", "b"])])
+        return results, loop.time() - start
+
+    results, elapsed = asyncio.run(run())
+    assert results["sum"] == 2
+    assert elapsed < 0.09
+
+
+def test_dependents_get_the_default_of_a_timed_out_stage():
+    async def slow():
+        await asyncio.sleep(1)
+        return "late"
+
+    async def use(slow):
+        return f"got {slow!r}"
+
+    results = asyncio.run(run_stages([
+        Stage("slow", slow, timeout=0.01, default=""),
+        Stage("use", use, deps=["slow"]),
+    ]))
+    assert results == {"slow": "", "use": "got ''"}
+
+
+def test_required_stage_failure_cancels_the_rest():
+    cancelled = []
+
+    async def fail():
+        raise RuntimeError("analysis failed")
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run_stages([Stage("required", fail), Stage("slow", slow, default=None)]))
+    assert cancelled == [True]
+
+
+def test_graph_is_checked():
+    async def noop():
+        return None
+
+    with pytest.raises(ValueError, match="unknown"):
+        asyncio.run(run_stages([Stage("a", noop, deps=["missing"])]))
+    with pytest.raises(ValueError, match="cycle"):
+        asyncio.run(run_stages([Stage("a", noop, deps=["b"]), Stage("b", noop, deps=["a"])]))
@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+import admission
+from admission import TokenBucket
+from prefetch import Prefetcher
+
+
+class FakeAgent:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = []
+        self.retrieval = SimpleNamespace(add_article=lambda *args: None)
+
+    async def search_location(self, name, city=None):
+        self.calls.append(("places", name))
+        await asyncio.sleep(self.delay)
+        return {"displayName": {"text": name}}
+
+    async def get_wikipedia_article(self, name):
+        self.calls.append(("wikipedia", name))
+        return f"About {name}"
+
+
+def session(session_id="s1", conversation_id="c1"):
+    return SimpleNamespace(session_id=session_id, conversation_id=conversation_id)
+
+
+def test_prefetched_result_is_shared():
+    async def run():
+        agent = FakeAgent()
+        prefetcher = Prefetcher(agent)
+        prefetcher.start(session(), ["Empire State Building"], {"name": "New York"})
+        result = await prefetcher.result(session(), "Empire State Building")
+        assert result == {"place": {"displayName": {"text": "Empire State Building"}}, "article": "About Empire State Building"}
+        assert await prefetcher.result(session(conversation_id="c2"), "Empire State Building") is None
+
+    asyncio.run(run())
+
+
+def test_prefetch_skipped_below_budget_reserve(monkeypatch):
+    places = TokenBucket(1, capacity=10)
+    places.tokens = 1
+    monkeypatch.setattr(admission.budgets, "places", places)
+
+    async def run():
+        agent = FakeAgent()
+        prefetcher = Prefetcher(agent)
+        prefetcher.start(session(), ["Empire State Building"], {"name": "New York"})
+        result = await prefetcher.result(session(), "Empire State Building")
+        # the Places budget is kept for the foreground lookup
+        assert result["place"] is None
+        assert result["article"] == "About Empire State Building"
+        assert agent.calls == [("wikipedia", "Empire State Building")]
+
+    asyncio.run(run())
+
+
+def test_match_needs_the_same_name():
+    async def run():
+        prefetcher = Prefetcher(FakeAgent())
+        prefetcher.start(session(), ["Central Park Zoo", "The Metropolitan Museum of Art"], {"name": "New York"})
+        assert prefetcher.covers(session(), "Metropolitan Museum of Art")
+        assert prefetcher.covers(session(), "Central Park Zo")
+        assert not prefetcher.covers(session(), "Central Park")
+        assert not prefetcher.covers(session(), "Park")
+
+    asyncio.run(run())
+
+
+def test_expired_and_reset_sessions_are_cancelled():
+    async def run():
+        prefetcher = Prefetcher(FakeAgent(delay=3600), ttl=0.05)
+        prefetcher.start(session("s1"), ["Central Park Zoo"], {"name": "New York"})
+        tasks = list(prefetcher._sessions["s1"]["tasks"].values())
+        await asyncio.sleep(0.06)
+        prefetcher.start(session("s2"), ["Central Park Zoo"], {"name": "New York"})
+        assert "s1" not in prefetcher._sessions
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(task.cancelled() for task in tasks)
+
+        # the session store started a new conversation for s2
+        assert not prefetcher.covers(session("s2", conversation_id="c2"), "Central Park Zoo")
+        assert "s2" not in prefetcher._sessions
+
+    asyncio.run(run())
+
+
+def test_cancelled_prefetch_leaves_upstream_circuits_closed(monkeypatch):
+    from agent import CityWalkAgent
+
+    monkeypatch.setenv("GOOGLE_API_KEY", "test")
+
+    async def slow_upstream(request):
+        if request.url.path.endswith(":searchNearby"):
+            return httpx.Response(200, json={"places": []})
+        await asyncio.sleep(2)
+        return httpx.Response(200, json={})
+
+    async def run():
+        agent = CityWalkAgent(client=SimpleNamespace(), http=httpx.AsyncClient(transport=httpx.MockTransport(slow_upstream)))
+        city = {"name": "New York", "latitude": 40.758, "longitude": -73.9855}
+        names = ["Central Park Zoo", "Brooklyn Bridge Park", "The Met", "MoMA", "Bryant Park"]
+        agent.prefetcher.start(session(), names, city)
+        tasks = list(agent.prefetcher._sessions["s1"]["tasks"].values())
+        await asyncio.sleep(0.1)
+        agent.prefetcher.cancel("s1")
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for endpoint in ("places", "wikipedia"):
+            breaker = agent.http.endpoints[endpoint].breaker
+            assert (breaker.state, breaker.failures) == ("closed", 0)
+        assert await agent.get_nearby_landmarks(city) == []
+        await agent.http.aclose()
+
+    asyncio.run(run())
+
+
+def test_prefetch_spans_stay_out_of_the_request_trace():
+    from metrics import span, start_trace
+
+    class TracedAgent(FakeAgent):
+        async def search_location(self, name, city=None):
+            with span("places_text_search"):
+                return await super().search_location(name, city)
+
+    async def run():
+        trace = start_trace()
+        prefetcher = Prefetcher(TracedAgent())
+        prefetcher.start(session(), ["Central Park Zoo"], {"name": "New York"})
+        await prefetcher.result(session(), "Central Park Zoo")
+        assert trace.spans == []
+
+    asyncio.run(run())
@@ -0,0 +1,45 @@
+import itertools
+import random
+
+import pytest
+
+from route import distance_matrix, path_length, plan_route
+
+START = {"name": "start", "latitude": 40.7580, "longitude": -73.9855}
+
+
+def stop(name, latitude, longitude):
+    return {"name": name, "latitude": latitude, "longitude": longitude}
+
+
+def brute_force(start, stops):
+    points = [start] + stops
+    dist = distance_matrix([p["latitude"] for p in points], [p["longitude"] for p in points])
+    return min(path_length([0] + list(order), dist) for order in itertools.permutations(range(1, len(points))))
+
+
+def test_no_stops():
+    assert plan_route(START, []) == ([], 0.0, 0.0)
+
+
+def test_stops_along_a_line_are_walked_in_order():
+    stops = [stop("far", 40.7880, -73.9855), stop("near", 40.7680, -73.9855), stop("middle", 40.7780, -73.9855)]
+    ordered, distance, minutes = plan_route(START, stops)
+    assert [s["name"] for s in ordered] == ["near", "middle", "far"]
+    # 0.03 degrees of latitude is about 3.3 km
+    assert distance == pytest.approx(3336, rel=0.01)
+    assert minutes == pytest.approx(distance / 80, abs=0.1)
+
+
+def test_route_visits_every_stop_once_and_is_near_optimal():
+    rng = random.Random(7)
+    stops = [stop(str(i), 40.75 + rng.uniform(0, 0.04), -73.99 + rng.uniform(0, 0.04)) for i in range(7)]
+    ordered, distance, _ = plan_route(START, stops)
+    assert sorted(s["name"] for s in ordered) == sorted(s["name"] for s in stops)
+    assert distance <= brute_force(START, stops) * 1.05
+
+
+def test_walking_speed_sets_duration():
+    stops = [stop("a", 40.7680, -73.9855)]
+    _, distance, minutes = plan_route(START, stops, walking_speed_kmh=6.0)
+    assert minutes == pytest.approx(distance / 100, abs=0.1)
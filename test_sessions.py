@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from cache import SQLiteCache
+from sessions import SessionStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def stores(request, tmp_path):
+    """Two stores over the same sessions, like two workers."""
+    if request.param == "memory":
+        store = SessionStore()
+        return store, store
+    path = str(tmp_path / "sessions.db")
+    return SessionStore(SQLiteCache(path, table="sessions")), SessionStore(SQLiteCache(path, table="sessions"))
+
+
+def turn(session, query, answer):
+    session.conversation = session.conversation + [{"role": "user", "content": query}, {"role": "assistant", "content": answer}]
+    session.turns += 1
+
+
+def test_turn_keeps_an_update_saved_meanwhile(stores):
+    async def run():
+        first, second = stores
+        session = await first.get("s1")
+        turn(session, "q1", "a1")
+        await first.save_turn(session)
+
+        # a turn starts in one worker while another stores inferred preferences
+        session = await first.get("s1")
+
+        def set_preferences(current):
+            current.preferences = {"likes": ["museums"]}
+            current.preferences_turn = current.turns
+            return current
+
+        await second.update("s1", set_preferences)
+        turn(session, "q2", "a2")
+        await first.save_turn(session)
+
+        stored = await second.get("s1")
+        assert stored.preferences == {"likes": ["museums"]}
+        assert [message["content"] for message in stored.conversation] == ["q1", "a1", "q2", "a2"]
+        assert stored.turns == 2
+
+    asyncio.run(run())
+
+
+def test_turn_of_a_reset_conversation_is_dropped(stores):
+    async def run():
+        first, second = stores
+        session = await first.get("s1")
+        turn(session, "q1", "a1")
+        await first.save_turn(session)
+
+        session = await first.get("s1")
+        reset = await second.reset("s1")
+        turn(reset, "hello", "hi")
+        await second.save_turn(reset)
+        turn(session, "q2", "a2")
+        await first.save_turn(session)
+
+        stored = await first.get("s1")
+        assert stored.conversation_id == reset.conversation_id
+        assert [message["content"] for message in stored.conversation] == ["hello", "hi"]
+
+    asyncio.run(run())
+
+
+def test_update_can_leave_the_session_alone(stores):
+    async def run():
+        first, _ = stores
+        assert await first.update("s1", lambda current: None) is None
+        assert (await first.get("s1")).version == 0
+
+    asyncio.run(run())
+
+
+def test_waiting_for_another_workers_write_lock_keeps_the_loop_running(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "sessions.db")
+    store = SessionStore(SQLiteCache(path, table="sessions"))
+    other_worker = sqlite3.connect(path, isolation_level=None)
+
+    async def run():
+        other_worker.execute("BEGIN IMMEDIATE")
+        session = await store.get("s1")
+        turn(session, "q1", "a1")
+        save = asyncio.ensure_future(store.save_turn(session))
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert ticks == 10 and not save.done()
+        other_worker.execute("COMMIT")
+        await save
+        assert (await store.get("s1")).turns == 1
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import re
+import unicodedata
+
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Lowercase, strip accents and punctuation, and collapse whitespace."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = _PUNCTUATION.sub(" ", text.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+# (first code point, last code point, script)
+_SCRIPT_RANGES = [
+    (0x0041, 0x024F, "Latin"),
+    (0x0370, 0x03FF, "Greek"),
+    (0x0400, 0x04FF, "Cyrillic"),
+    (0x0590, 0x05FF, "Hebrew"),
+    (0x0600, 0x06FF, "Arabic"),
+    (0x0900, 0x097F, "Devanagari"),
+    (0x0E00, 0x0E7F, "Thai"),
+    (0x1100, 0x11FF, "Hangul"),
+    (0x3040, 0x309F, "Hiragana"),
+    (0x30A0, 0x30FF, "Katakana"),
+    (0x3400, 0x4DBF, "Han"),
+    (0x4E00, 0x9FFF, "Han"),
+    (0xAC00, 0xD7AF, "Hangul"),
+]
+
+# scripts used by (practically) a single language
+SCRIPT_LANGUAGES = {
+    "Greek": "Greek",
+    "Hebrew": "Hebrew",
+    "Thai": "Thai",
+    "Hangul": "Korean",
+    "Hiragana": "Japanese",
+    "Katakana": "Japanese",
+}
+
+
+def detect_script(text):
+    """Return the dominant writing system of ``text``, or ``""`` if it has no letters."""
+    counts = {}
+    for char in text:
+        if not char.isalpha():
+            continue
+        code = ord(char)
+        for first, last, script in _SCRIPT_RANGES:
+            if first <= code <= last:
+                counts[script] = counts.get(script, 0) + 1
+                break
+    if not counts:
+        return ""
+    # any kana means Japanese, even if most characters are kanji
+    if "Hiragana" in counts or "Katakana" in counts:
+        return "Hiragana" if counts.get("Hiragana", 0) >= counts.get("Katakana", 0) else "Katakana"
+    return max(counts, key=counts.get)
+
+
+# scripts that almost always mean one language in the queries we get
+_SCRIPT_DEFAULT_LANGUAGES = {
+    "Han": "Chinese",
+    "Arabic": "Arabic",
+    "Cyrillic": "Russian",
+    "Devanagari": "Hindi",
+}
+
+# short, frequent words that tell the common Latin-script languages apart
+_LATIN_MARKERS = {
+    "English": {"the", "and", "is", "are", "what", "where", "how", "can", "you", "me", "of", "to", "about", "tell", "i", "we", "this", "there"},
+    "Spanish": {"el", "la", "los", "las", "es", "que", "de", "y", "en", "por", "donde", "como", "qué", "dónde", "cuál", "quiero", "hay", "para"},
+    "French": {"le", "la", "les", "est", "et", "de", "des", "que", "où", "je", "vous", "une", "pour", "quel", "quelle", "sur", "dans", "c'est"},
+    "German": {"der", "die", "das", "und", "ist", "ich", "wo", "wie", "was", "nicht", "ein", "eine", "mit", "zu", "gibt", "es", "über"},
+    "Italian": {"il", "lo", "la", "gli", "e", "è", "che", "di", "dove", "come", "cosa", "vorrei", "una", "per", "sono", "della", "del"},
+    "Portuguese": {"o", "a", "os", "as", "é", "que", "de", "e", "onde", "como", "não", "uma", "para", "quero", "você", "do", "da"},
+}
+
+
+def detect_language(text):
+    """Guess the language of ``text`` without a model, or return ``""`` when unsure.
+
+    Scripts used by one language decide it outright. Latin-script text is
+    scored by the common function words it contains and only classified when
+    one language clearly wins, so short or mixed queries stay undecided.
+    """
+    script = detect_script(text)
+    if script in SCRIPT_LANGUAGES:
+        return SCRIPT_LANGUAGES[script]
+    if script in _SCRIPT_DEFAULT_LANGUAGES:
+        return _SCRIPT_DEFAULT_LANGUAGES[script]
+    if script != "Latin":
+        return ""
+
+    words = re.findall(r"[\w']+", text.lower())
+    scores = {language: sum(1 for word in words if word in markers) for language, markers in _LATIN_MARKERS.items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, runner_up) = ranked[0], ranked[1]
+    if best_score >= 2 and best_score >= 2 * runner_up:
+        return best
+    return ""
@@ -0,0 +1,164 @@
+"""Fill the persistent caches for popular cities before the first visitors arrive.
+
+For every city centre this fetches the nearby landmarks of the geohash tile
+around it (and its neighbours), then the Places details and Wikipedia
+article of the best rated landmarks. Everything goes through the agent's
+own lookups, so it lands in the caches under CACHE_DB_PATH with the keys
+every worker reads.
+
+    CACHE_DB_PATH=cache.db python warmup.py
+    CACHE_DB_PATH=cache.db python warmup.py --cities cities.txt --top 15 --places-qps 5
+
+A cities file has one city per line, either a name to look up or
+"name,latitude,longitude". By default the cities are taken from the file
+names in RETRIEVAL_CORPUS_DIR (reddit_discussions/).
+"""
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+import settings
+from geo import geohash_center, geohash_encode, geohash_neighbours
+
+logger = logging.getLogger("warmup")
+
+
+class RateLimiter:
+    """Spaces calls out to at most ``rate`` per second (no limit if ``rate`` is 0)."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def read_cities(path):
+    cities = []
+    if path:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = [part.strip() for part in line.split(",")]
+                if len(parts) == 3:
+                    cities.append({"name": parts[0], "latitude": float(parts[1]), "longitude": float(parts[2])})
+                else:
+                    cities.append({"name": line})
+    else:
+        for corpus in sorted(glob.glob(os.path.join(settings.RETRIEVAL_CORPUS_DIR, "*.txt"))):
+            cities.append({"name": os.path.splitext(os.path.basename(corpus))[0].replace("_", " ")})
+    return cities
+
+
+class Warmup:
+    def __init__(self, agent, workers=8, places_qps=5.0, wikipedia_qps=10.0, top=10, rings=1):
+        self.agent = agent
+        self.slots = asyncio.Semaphore(workers)
+        self.places = RateLimiter(places_qps)
+        self.wikipedia = RateLimiter(wikipedia_qps)
+        self.top = top
+        self.rings = rings
+        self.stats = Counter()
+
+    async def call(self, limiter, kind, func, *args):
+        # bounded worker pool plus a per-upstream rate limit
+        async with self.slots:
+            await limiter.wait()
+            try:
+                result = await func(*args)
+            except Exception as e:
+                self.stats[f"{kind}_failed"] += 1
+                logger.warning("%s %s failed: %s", kind, args[0], e)
+                return None
+            self.stats[kind] += 1
+            return result
+
+    async def resolve(self, city):
+        if "latitude" in city:
+            return city
+        place = await self.call(self.places, "city", self.agent.search_location, city["name"])
+        if not place or "location" not in place:
+            logger.warning("Could not find %s", city["name"])
+            return None
+        return {"name": city["name"], "latitude": place["location"]["latitude"], "longitude": place["location"]["longitude"]}
+
+    def tiles(self, city):
+        tiles = {geohash_encode(city["latitude"], city["longitude"], settings.LANDMARK_CACHE_PRECISION)}
+        ring = set(tiles)
+        for _ in range(self.rings):
+            ring = {neighbour for tile in ring for neighbour in geohash_neighbours(tile)} - tiles
+            tiles |= ring
+        return sorted(tiles)
+
+    async def warm_city(self, city):
+        city = await self.resolve(city)
+        if city is None:
+            return
+
+        async def landmarks(tile):
+            latitude, longitude = geohash_center(tile)
+            return await self.call(
+                self.places, "landmarks", self.agent.get_nearby_landmarks, {"latitude": latitude, "longitude": longitude}
+            ) or []
+
+        tiles = self.tiles(city)
+        found = {}
+        for places in await asyncio.gather(*[landmarks(tile) for tile in tiles]):
+            for place in places:
+                location = place["location"]
+                found.setdefault(location["displayName"]["text"], location.get("rating", 0))
+        names = sorted(found, key=found.get, reverse=True)[:self.top]
+
+        await asyncio.gather(*[self.call(self.places, "place", self.agent.search_location, name, city) for name in names])
+        await asyncio.gather(*[self.call(self.wikipedia, "article", self.agent.get_wikipedia_article, name) for name in names])
+        logger.info("Warmed %s: %d tiles, %d landmarks", city["name"], len(tiles), len(names))
+
+    async def run(self, cities):
+        await asyncio.gather(*[self.warm_city(city) for city in cities])
+
+
+async def main(args):
+    from agent import CityWalkAgent
+
+    cities = read_cities(args.cities)
+    if not cities:
+        sys.exit("No cities to warm up")
+    agent = CityWalkAgent()
+    warmup = Warmup(agent, args.workers, args.places_qps, args.wikipedia_qps, args.top, args.rings)
+    start = time.perf_counter()
+    try:
+        await warmup.run(cities)
+    finally:
+        await agent.aclose()
+    print(f"{len(cities)} cities in {time.perf_counter() - start:.1f}s: "
+          + ", ".join(f"{kind}={count}" for kind, count in sorted(warmup.stats.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cities", help="file with one city per line; defaults to the cities in RETRIEVAL_CORPUS_DIR")
+    parser.add_argument("--top", type=int, default=10, help="landmarks per city to fetch details and articles for")
+    parser.add_argument("--rings", type=int, default=1, help="rings of neighbouring landmark tiles to warm around each centre")
+    parser.add_argument("--workers", type=int, default=8, help="upstream calls in flight at once")
+    parser.add_argument("--places-qps", type=float, default=5.0, help="Google Places calls per second, 0 for no limit")
+    parser.add_argument("--wikipedia-qps", type=float, default=10.0, help="Wikipedia calls per second, 0 for no limit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    if not settings.CACHE_DB_PATH:
+        sys.exit("Set CACHE_DB_PATH to the cache database the server uses; in-memory caches would be thrown away")
+    asyncio.run(main(args))